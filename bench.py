@@ -0,0 +1,384 @@
+"""Benchmarks for the converters, statistics and isochrone pipeline.
+
+Each stage runs in a forked child process on a synthetic feed of the
+given scale, and reports wall time and peak RSS. Results are written as
+JSON, to compare between runs:
+
+  python bench.py --output bench.json
+  python bench.py --scales small --stages haversine,schedule_write
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import BaseHTTPServer
+import SocketServer
+
+import instrument
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURE = os.path.join(HERE, 'test.geojson')
+
+# Synthetic feed sizes.
+SCALES = {
+  'small': {'trips': 10, 'stops': 100, 'routes': 2},
+  'medium': {'trips': 1000, 'stops': 100, 'routes': 20},
+  'large': {'trips': 100000, 'stops': 50000, 'routes': 500},
+}
+
+# Stops along each synthetic route.
+ROUTE_STOPS = 30
+
+##### Synthetic data #####
+
+def synthetic_stops(count, seed=0):
+  """Stops scattered over a roughly 30 km square."""
+  rnd = random.Random(seed)
+  return [(-122.3 + rnd.random() * 0.35, 37.7 + rnd.random() * 0.27) for i in range(count)]
+
+def synthetic_routes(stops, routes, seed=0):
+  """Stop index sequences for each route."""
+  rnd = random.Random(seed)
+  n = min(ROUTE_STOPS, len(stops))
+  return [rnd.sample(range(len(stops)), n) for i in range(routes)]
+
+def make_gtfs(path, trips, stops, routes, seed=0):
+  """Write a synthetic GTFS .zip."""
+  coords = synthetic_stops(stops, seed)
+  patterns = synthetic_routes(coords, routes, seed)
+  tables = {}
+  def table(name, header, rows):
+    f = tempfile.TemporaryFile()
+    writer = csv.writer(f)
+    writer.writerow(header)
+    writer.writerows(rows)
+    f.seek(0)
+    tables[name] = f.read()
+  table('agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'], [['bench', 'Bench', 'http://www.example.com', 'America/Los_Angeles']])
+  table('calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'], [['1', '1', '1', '1', '1', '1', '1', '1', '20100101', '20200101']])
+  table('stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'], [[i, 'Stop %s'%i, lat, lon] for i, (lon, lat) in enumerate(coords)])
+  table('routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type'], [[i, 'bench', i, 'Route %s'%i, '', 3] for i in range(routes)])
+  table('shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], [
+    ['%s-%s'%(r, d), coords[s][1], coords[s][0], seq]
+    for r, pattern in enumerate(patterns) for d in (0, 1) for seq, s in enumerate(pattern if d == 0 else pattern[::-1])
+  ])
+  trip_rows, stop_time_rows = [], []
+  for t in range(trips):
+    r, d = t % routes, (t // routes) % 2
+    pattern = patterns[r] if d == 0 else patterns[r][::-1]
+    start = 5 * 3600 + (t // (routes * 2)) * 600
+    trip_rows.append([r, '1', t, 'Route %s'%r, d, '%s-%s'%(r, d)])
+    for seq, s in enumerate(pattern):
+      c = clock(start + seq * 90)
+      stop_time_rows.append([t, c, c, s, seq + 1])
+  table('trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id'], trip_rows)
+  table('stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'], stop_time_rows)
+  with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+    for name, data in sorted(tables.items()):
+      zf.writestr(name, data)
+  return path
+
+def make_network(path, stops, routes, seed=0):
+  """Write a synthetic network GeoJSON for geojson_gtfs.py"""
+  coords = synthetic_stops(stops, seed)
+  features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': c}, 'properties': {'stop_id': i + 1}} for i, c in enumerate(coords)]
+  for i, pattern in enumerate(synthetic_routes(coords, routes, seed)):
+    features.append({'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': [coords[s] for s in pattern]}, 'properties': {'route_id': i + 1, 'headway': 600, 'speed': 20}})
+  with open(path, 'wb') as f:
+    json.dump({'type': 'FeatureCollection', 'features': features}, f)
+  return path
+
+def clock(t):
+  return '%02d:%02d:%02d'%(t // 3600, t % 3600 // 60, t % 60)
+
+##### Stub OTP server #####
+
+class StubOTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers the surface, isochrone and indicator requests make_isochrones.py makes."""
+  protocol_version = 'HTTP/1.1'
+
+  def respond(self, data):
+    body = json.dumps(data)
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    self.respond({'id': 1})
+
+  def do_GET(self):
+    if '/isochrone' in self.path:
+      self.respond({'type': 'FeatureCollection', 'features': []})
+    else:
+      self.respond({'data': {}})
+
+  def log_message(self, *args):
+    pass
+
+class StubOTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+def stub_otp():
+  """Start a stub OTP server on a free local port; returns (server, url)."""
+  server = StubOTPServer(('127.0.0.1', 0), StubOTPHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, 'http://127.0.0.1:%s'%server.server_address[1]
+
+##### Stages #####
+# Each stage takes (scale, workdir), and returns the number of items
+# processed, for a rate.
+
+def bench_haversine(scale, workdir):
+  import haversine
+  coords = synthetic_stops(scale['stops'])
+  for a, b in zip(coords[:-1], coords[1:]):
+    haversine.haversine(a, b)
+  haversine.segments(coords)
+  return len(coords)
+
+def bench_schedule_add_stop(scale, workdir):
+  import geojson
+  from geojson_gtfs import Schedule, Stop
+  sched = Schedule('bench', tolerance=5.0)
+  for c in synthetic_stops(scale['stops']):
+    sched.add_stop(Stop(geometry=geojson.Point(c)))
+  return scale['stops']
+
+def _schedule(scale):
+  import geojson
+  from geojson_gtfs import Schedule, Stop, Route
+  sched = Schedule('bench')
+  coords = synthetic_stops(scale['stops'])
+  for c in coords:
+    sched.add_stop(Stop(geometry=geojson.Point(c)))
+  for pattern in synthetic_routes(coords, scale['routes']):
+    sched.add_route(Route(geometry=geojson.LineString([coords[s] for s in pattern]), properties={}))
+  return sched
+
+def bench_add_trip_speed(scale, workdir):
+  import datetime
+  sched = _schedule(scale)
+  routes = sched.routes.values()
+  start = datetime.datetime(2014, 1, 1, 5)
+  _reset()
+  stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+  try:
+    for t in range(scale['trips']):
+      route = routes[t % len(routes)]
+      route.add_trip_speed(route_id=route.properties['route_id'], stop_ids=route.properties['stop_ids'], start=start, speed=20, stops=sched.stops)
+  finally:
+    sys.stdout = stdout
+  return scale['trips']
+
+def _patterns(sched, trips):
+  routes = sched.routes.values()
+  per_route = max(1, trips // len(routes))
+  for route in routes:
+    route.add_pattern_speed(stop_ids=route.properties['stop_ids'], speed=20, stops=sched.stops).add_trips([5 * 3600 + i * 60 for i in range(per_route)])
+  return per_route * len(routes)
+
+def bench_add_pattern_speed(scale, workdir):
+  sched = _schedule(scale)
+  _reset()
+  return _patterns(sched, scale['trips'])
+
+def bench_schedule_write(scale, workdir):
+  sched = _schedule(scale)
+  trips = _patterns(sched, scale['trips'])
+  out = os.path.join(workdir, 'gtfs')
+  os.mkdir(out)
+  _reset()
+  sched.write(path=out)
+  return trips
+
+def bench_schedule_write_zip(scale, workdir):
+  sched = _schedule(scale)
+  trips = _patterns(sched, scale['trips'])
+  _reset()
+  sched.write(path=os.path.join(workdir, 'feed.zip'))
+  return trips
+
+def bench_feed_load(scale, workdir):
+  import feed
+  path = make_gtfs(os.path.join(workdir, 'feed.zip'), **scale)
+  _reset()
+  feed.Feed.from_zip(path)
+  return scale['trips']
+
+def bench_feed_cache(scale, workdir):
+  import feed
+  path = make_gtfs(os.path.join(workdir, 'feed.zip'), **scale)
+  feed.open_feed(path, cache=os.path.join(workdir, 'cache'))
+  # Time the cached open.
+  _reset()
+  feed.open_feed(path, cache=os.path.join(workdir, 'cache'))
+  return scale['trips']
+
+def bench_route_info(scale, workdir):
+  import feed
+  import gtfs_geojson
+  path = make_gtfs(os.path.join(workdir, 'feed.zip'), **scale)
+  gtfs = feed.open_feed(path, cache=None)
+  _reset()
+  count = 0
+  for f in gtfs_geojson.export_routes(gtfs.routes, gtfs, text=True):
+    count += 1
+  return count
+
+def bench_routestats(scale, workdir):
+  import feed
+  import routestats
+  path = make_gtfs(os.path.join(workdir, 'feed.zip'), **scale)
+  gtfs = feed.open_feed(path, cache=None)
+  _reset()
+  return len(routestats.all_routes(gtfs))
+
+def _convert(filename, output, *options):
+  import subprocess
+  if subprocess.call([sys.executable, os.path.join(HERE, 'geojson_gtfs.py'), 'bench', filename, output] + list(options), stdout=open(os.devnull, 'w')):
+    raise RuntimeError("geojson_gtfs.py failed")
+
+def bench_geojson_gtfs(scale, workdir):
+  """Convert the bundled test.geojson fixture; the same at every scale, so run once."""
+  # The fixture's routes have no headway or speed of their own.
+  _convert(FIXTURE, os.path.join(workdir, 'fixture'), '--headways', '600', '--speeds', '20', '--jobs', '1')
+  return 1
+
+def bench_geojson_gtfs_network(scale, workdir):
+  """Convert a synthetic network of the given scale."""
+  path = make_network(os.path.join(workdir, 'network.geojson'), scale['stops'], scale['routes'])
+  _reset()
+  _convert(path, os.path.join(workdir, 'feed.zip'))
+  return scale['routes']
+
+def bench_geojson_gtfs_scenarios(scale, workdir):
+  """A 50 scenario headway sweep over a synthetic network."""
+  path = make_network(os.path.join(workdir, 'network.geojson'), scale['stops'], scale['routes'])
+  _reset()
+  _convert(path, os.path.join(workdir, 'scenarios'), '--headways', ','.join(str(i) for i in range(300, 3300, 60)))
+  return 50
+
+def bench_make_isochrones(scale, workdir):
+  import make_isochrones
+  server, url = stub_otp()
+  stops = [{'stop_id': str(i), 'stop_lat': lat, 'stop_lon': lon} for i, (lon, lat) in enumerate(synthetic_stops(min(scale['stops'], 1000)))]
+  args = argparse.Namespace(host=url, date='10/06/14', time='08:00:00', cutoff=90, spacing=5, outdir=workdir, banned=[], scenario='bench')
+  pool = multiprocessing.pool.ThreadPool(8)
+  try:
+    pool.map(lambda stop:make_isochrones.isochrone(args, stop), stops)
+  finally:
+    pool.close()
+    server.shutdown()
+  return len(stops)
+
+STAGES = [
+  ('haversine', bench_haversine),
+  ('schedule_add_stop', bench_schedule_add_stop),
+  ('add_trip_speed', bench_add_trip_speed),
+  ('add_pattern_speed', bench_add_pattern_speed),
+  ('schedule_write', bench_schedule_write),
+  ('schedule_write_zip', bench_schedule_write_zip),
+  ('feed_load', bench_feed_load),
+  ('feed_cache', bench_feed_cache),
+  ('route_info', bench_route_info),
+  ('routestats', bench_routestats),
+  ('geojson_gtfs', bench_geojson_gtfs),
+  ('geojson_gtfs_network', bench_geojson_gtfs_network),
+  ('geojson_gtfs_scenarios', bench_geojson_gtfs_scenarios),
+  ('make_isochrones', bench_make_isochrones),
+]
+
+# Stages that run geojson_gtfs.py in a subprocess; their memory is the child's.
+SUBPROCESS = ['geojson_gtfs', 'geojson_gtfs_network', 'geojson_gtfs_scenarios']
+
+# Stages that ignore the scale; only run at the first one.
+UNSCALED = ['geojson_gtfs']
+
+##### Runner #####
+
+_start = {}
+
+def _reset():
+  """Start timing from here; for stages that need setup first."""
+  _start['time'] = time.time()
+
+def _child(stage, scale, conn, children=False):
+  workdir = tempfile.mkdtemp(prefix='transvisor-bench-')
+  # Silence the tools' progress output.
+  stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+  try:
+    base = instrument.peak_rss()
+    _reset()
+    count = stage(scale, workdir)
+    seconds = time.time() - _start['time']
+    peak = instrument.peak_rss(resource.RUSAGE_CHILDREN) if children else instrument.peak_rss()
+    conn.send({'seconds': seconds, 'count': count, 'peak_rss_kb': peak, 'base_rss_kb': base})
+  except Exception, e:
+    conn.send({'error': '%s: %s'%(e.__class__.__name__, e)})
+  finally:
+    sys.stdout = stdout
+    shutil.rmtree(workdir, ignore_errors=True)
+    conn.close()
+
+def run(name, stage, scale_name, repeat=1):
+  """Run a stage in a fresh process, repeat times; keep the fastest."""
+  best = None
+  for i in range(repeat):
+    parent, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=_child, args=(stage, SCALES[scale_name], child, name in SUBPROCESS))
+    p.start()
+    result = parent.recv()
+    p.join()
+    if 'error' in result:
+      best = result
+      break
+    if best is None or result['seconds'] < best['seconds']:
+      best = result
+  best.update({'stage': name, 'scale': scale_name})
+  if 'seconds' in best:
+    best['rate'] = best['count'] / max(best['seconds'], 1e-9)
+  return best
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--output", help="JSON results file", default="bench.json")
+  parser.add_argument("--scales", help="Comma separated: %s"%",".join(sorted(SCALES)), default="small,medium")
+  parser.add_argument("--stages", help="Comma separated: %s"%",".join(name for name, _ in STAGES))
+  parser.add_argument("--repeat", help="Runs per stage; the fastest is kept", default=3, type=int)
+  args = parser.parse_args()
+
+  stages = [(name, stage) for name, stage in STAGES if not args.stages or name in args.stages.split(",")]
+  results = []
+  for i, scale in enumerate(args.scales.split(",")):
+    for name, stage in stages:
+      if i and name in UNSCALED:
+        continue
+      result = run(name, stage, scale, repeat=args.repeat)
+      results.append(result)
+      if 'error' in result:
+        print "%-20s %-8s ERROR %s"%(name, scale, result['error'])
+      else:
+        print "%-20s %-8s %9.3fs %12.0f/s %9s KB"%(name, scale, result['seconds'], result['rate'], result['peak_rss_kb'])
+
+  with open(args.output, 'w') as f:
+    json.dump({
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'scales': SCALES,
+      'results': results
+    }, f, indent=2)
@@ -0,0 +1,361 @@
+"""Columnar, in-memory GTFS tables.
+
+The pygtfs ORM loads trips, stop_times and stops one object (and one
+SELECT) at a time through lazy relationships. A Feed instead reads each
+table in a single pass -- straight from the GTFS .zip, or with one bulk
+query per table from a pygtfs database -- into NumPy arrays, and indexes
+them so a route's trips, a trip's stop_times, or a shape's points are an
+array slice away.
+"""
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy
+
+import instrument
+
+# Preprocessed feeds are cached here, keyed by checksum of the source file.
+CACHE = os.path.expanduser(os.path.join('~', '.cache', 'transvisor'))
+CACHE_VERSION = 1
+
+# Columns saved to, and memory-mapped from, the cache.
+ARRAYS = [
+  'stop_id', 'stop_name', 'stop_lon', 'stop_lat',
+  'trip_id', 'trip_route', 'trip_service', 'trip_shape', 'trip_headsign', 'trip_direction',
+  'st_trip', 'st_stop', 'st_sequence', 'st_arrival', 'st_departure', 'trip_offsets',
+  'shape_id', 'shape_lon', 'shape_lat', 'shape_offsets'
+]
+
+ROUTE_FIELDS = ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type']
+
+def parse_time(value):
+  """GTFS HH:MM:SS to seconds since midnight; -1 if missing."""
+  if not value:
+    return -1
+  h, m, s = value.strip().split(':')
+  return int(h) * 3600 + int(m) * 60 + int(s)
+
+def interval_seconds(value):
+  """pygtfs Interval (timedelta) to seconds since midnight; -1 if missing."""
+  if value is None:
+    return -1
+  return int(value.days * 86400 + value.seconds)
+
+def read_csv(zf, name, fields):
+  """Read the named columns from a CSV table in a GTFS .zip."""
+  columns = dict((field, []) for field in fields)
+  try:
+    f = zf.open(name)
+  except KeyError:
+    return columns
+  reader = csv.reader(f)
+  header = [i.strip() for i in next(reader, [])]
+  if header and header[0].startswith('\xef\xbb\xbf'):
+    header[0] = header[0][3:]
+  index = [(field, header.index(field) if field in header else None) for field in fields]
+  for row in reader:
+    if not row:
+      continue
+    for field, i in index:
+      columns[field].append(row[i].strip() if i is not None and i < len(row) else '')
+  f.close()
+  return columns
+
+def lookup(keys, values):
+  """Index of each of values in keys, or -1 if not found."""
+  keys = numpy.asarray(keys)
+  values = numpy.asarray(values)
+  if not len(keys) or not len(values):
+    return numpy.zeros(len(values), dtype=numpy.int32) - 1
+  order = numpy.argsort(keys, kind='mergesort')
+  pos = numpy.searchsorted(keys[order], values)
+  pos = numpy.clip(pos, 0, len(keys) - 1)
+  found = order[pos]
+  found[keys[found] != values] = -1
+  return found.astype(numpy.int32)
+
+def offsets(groups, count):
+  """Start offsets of each group in an array sorted by group index."""
+  o = numpy.zeros(count + 1, dtype=numpy.int64)
+  numpy.cumsum(numpy.bincount(groups, minlength=count), out=o[1:])
+  return o
+
+def strings(values):
+  return numpy.array(values, dtype=str)
+
+class Feed(object):
+  """Columnar GTFS tables.
+
+  Per-stop and per-trip columns are NumPy arrays; stop_times are sorted
+  by (trip, stop_sequence) and shape points by (shape, sequence), with
+  *_offsets arrays giving each trip's or shape's slice.
+  """
+  def __init__(self, routes, services, stops, trips, stop_times, shapes):
+    # Routes are few; keep them as dicts.
+    self.routes = routes
+    # service_ids with Monday service.
+    self.services = set(services)
+
+    self.stop_id = strings(stops['stop_id'])
+    self.stop_name = strings(stops['stop_name'])
+    self.stop_lon = numpy.array(stops['stop_lon'], dtype=numpy.float64)
+    self.stop_lat = numpy.array(stops['stop_lat'], dtype=numpy.float64)
+
+    self.trip_id = strings(trips['trip_id'])
+    self.trip_route = strings(trips['route_id'])
+    self.trip_service = strings(trips['service_id'])
+    self.trip_shape = strings(trips['shape_id'])
+    self.trip_headsign = strings(trips['trip_headsign'])
+    self.trip_direction = numpy.array(trips['direction_id'], dtype=numpy.int8)
+
+    # Sort stop_times by trip, then stop_sequence.
+    st_trip = lookup(self.trip_id, strings(stop_times['trip_id']))
+    st_stop = lookup(self.stop_id, strings(stop_times['stop_id']))
+    st_sequence = numpy.array(stop_times['stop_sequence'], dtype=numpy.int32)
+    st_arrival = numpy.array(stop_times['arrival_time'], dtype=numpy.int32)
+    st_departure = numpy.array(stop_times['departure_time'], dtype=numpy.int32)
+    keep = (st_trip >= 0) & (st_stop >= 0)
+    order = numpy.lexsort((st_sequence[keep], st_trip[keep]))
+    self.st_trip = st_trip[keep][order]
+    self.st_stop = st_stop[keep][order]
+    self.st_sequence = st_sequence[keep][order]
+    self.st_arrival = st_arrival[keep][order]
+    self.st_departure = st_departure[keep][order]
+    self.trip_offsets = offsets(self.st_trip, len(self.trip_id))
+
+    # Sort shape points by shape, then sequence.
+    shape_ids = strings(shapes['shape_id'])
+    self.shape_id, shape_index = numpy.unique(shape_ids, return_inverse=True)
+    shape_sequence = numpy.array(shapes['shape_pt_sequence'], dtype=numpy.int32)
+    order = numpy.lexsort((shape_sequence, shape_index))
+    self.shape_lon = numpy.array(shapes['shape_pt_lon'], dtype=numpy.float64)[order]
+    self.shape_lat = numpy.array(shapes['shape_pt_lat'], dtype=numpy.float64)[order]
+    self.shape_offsets = offsets(shape_index[order], len(self.shape_id))
+
+    self._index()
+
+  def _index(self):
+    """Group trips by route."""
+    self.route_trips = {}
+    order = numpy.argsort(self.trip_route, kind='mergesort')
+    if not len(order):
+      return
+    routes = self.trip_route[order]
+    bounds = numpy.flatnonzero(routes[1:] != routes[:-1]) + 1
+    for chunk in numpy.split(order, bounds):
+      self.route_trips[self.trip_route[chunk[0]]] = chunk
+
+  @classmethod
+  def from_zip(cls, filename):
+    """Read a GTFS .zip directly."""
+    zf = zipfile.ZipFile(filename)
+    routes = read_csv(zf, 'routes.txt', ROUTE_FIELDS)
+    routes = [dict((k, routes[k][i]) for k in ROUTE_FIELDS) for i in range(len(routes['route_id']))]
+    for route in routes:
+      route['route_type'] = int(route['route_type']) if route['route_type'] else None
+    calendar = read_csv(zf, 'calendar.txt', ['service_id', 'monday'])
+    services = [s for s, m in zip(calendar['service_id'], calendar['monday']) if m == '1']
+    stops = read_csv(zf, 'stops.txt', ['stop_id', 'stop_name', 'stop_lon', 'stop_lat'])
+    stops['stop_lon'] = [float(i or 0) for i in stops['stop_lon']]
+    stops['stop_lat'] = [float(i or 0) for i in stops['stop_lat']]
+    trips = read_csv(zf, 'trips.txt', ['trip_id', 'route_id', 'service_id', 'shape_id', 'trip_headsign', 'direction_id'])
+    trips['direction_id'] = [int(i) if i else -1 for i in trips['direction_id']]
+    stop_times = read_csv(zf, 'stop_times.txt', ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time'])
+    stop_times['arrival_time'] = map(parse_time, stop_times['arrival_time'])
+    stop_times['departure_time'] = map(parse_time, stop_times['departure_time'])
+    shapes = read_csv(zf, 'shapes.txt', ['shape_id', 'shape_pt_lon', 'shape_pt_lat', 'shape_pt_sequence'])
+    zf.close()
+    return cls(routes, services, stops, trips, stop_times, shapes)
+
+  @classmethod
+  def from_schedule(cls, sched):
+    """Read a pygtfs Schedule with one bulk query per table."""
+    from pygtfs import gtfs_entities as e
+    q = sched.session.query
+    routes = [dict(zip(ROUTE_FIELDS, row)) for row in q(*[getattr(e.Route, k) for k in ROUTE_FIELDS])]
+    for route in routes:
+      route['route_id'] = text([route['route_id']])[0]
+    services = text([row[0] for row in q(e.Service.service_id).filter(e.Service.monday == True)])
+    stops = columns(q(e.Stop.stop_id, e.Stop.stop_name, e.Stop.stop_lon, e.Stop.stop_lat),
+      ['stop_id', 'stop_name', 'stop_lon', 'stop_lat'])
+    for k in ['stop_id', 'stop_name']:
+      stops[k] = text(stops[k])
+    for k in ['stop_lon', 'stop_lat']:
+      stops[k] = [float(i or 0) for i in stops[k]]
+    trips = columns(q(e.Trip.trip_id, e.Trip.route_id, e.Trip.service_id, e.Trip.shape_id, e.Trip.trip_headsign, e.Trip.direction_id),
+      ['trip_id', 'route_id', 'service_id', 'shape_id', 'trip_headsign', 'direction_id'])
+    for k in ['trip_id', 'route_id', 'service_id', 'shape_id', 'trip_headsign']:
+      trips[k] = text(trips[k])
+    trips['direction_id'] = [-1 if i is None else int(i) for i in trips['direction_id']]
+    stop_times = columns(q(e.StopTime.trip_id, e.StopTime.stop_id, e.StopTime.stop_sequence, e.StopTime.arrival_time, e.StopTime.departure_time),
+      ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time'])
+    stop_times['trip_id'] = text(stop_times['trip_id'])
+    stop_times['stop_id'] = text(stop_times['stop_id'])
+    stop_times['arrival_time'] = map(interval_seconds, stop_times['arrival_time'])
+    stop_times['departure_time'] = map(interval_seconds, stop_times['departure_time'])
+    shapes = columns(q(e.ShapePoint.shape_id, e.ShapePoint.shape_pt_lon, e.ShapePoint.shape_pt_lat, e.ShapePoint.shape_pt_sequence),
+      ['shape_id', 'shape_pt_lon', 'shape_pt_lat', 'shape_pt_sequence'])
+    shapes['shape_id'] = text(shapes['shape_id'])
+    return cls(routes, services, stops, trips, stop_times, shapes)
+
+  ##### Cache #####
+
+  def save(self, path):
+    """Save as a directory of .npy arrays plus a JSON header."""
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+      os.makedirs(parent)
+    # Write to a temporary directory, then move into place.
+    tmp = tempfile.mkdtemp(dir=parent)
+    try:
+      for name in ARRAYS:
+        numpy.save(os.path.join(tmp, '%s.npy'%name), getattr(self, name))
+      with open(os.path.join(tmp, 'feed.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'routes': self.routes, 'services': sorted(self.services)}, f)
+      os.rename(tmp, path)
+    except OSError:
+      # Another process got there first.
+      shutil.rmtree(tmp, ignore_errors=True)
+      if not os.path.exists(os.path.join(path, 'feed.json')):
+        raise
+
+  @classmethod
+  def load(cls, path):
+    """Open a saved Feed; the arrays are memory-mapped, not read."""
+    with open(os.path.join(path, 'feed.json')) as f:
+      header = json.load(f)
+    if header.get('version') != CACHE_VERSION:
+      raise ValueError("Incompatible feed cache: %s"%path)
+    self = cls.__new__(cls)
+    self.routes = [dict((str(k), text([v])[0] if isinstance(v, unicode) else v) for k, v in route.items()) for route in header['routes']]
+    self.services = set(text(header['services']))
+    for name in ARRAYS:
+      setattr(self, name, numpy.load(os.path.join(path, '%s.npy'%name), mmap_mode='r'))
+    self._index()
+    return self
+
+  ##### Accessors #####
+
+  def stop_times(self, trip):
+    """Slice of the stop_times columns for a trip."""
+    return slice(self.trip_offsets[trip], self.trip_offsets[trip+1])
+
+  def direction(self, trip):
+    d = int(self.trip_direction[trip])
+    return None if d < 0 else d
+
+  def shape(self, shape_id):
+    """List of (lon, lat) shape points, or None."""
+    i = numpy.searchsorted(self.shape_id, shape_id)
+    if i >= len(self.shape_id) or self.shape_id[i] != shape_id:
+      return None
+    s = slice(self.shape_offsets[i], self.shape_offsets[i+1])
+    return zip(self.shape_lon[s].tolist(), self.shape_lat[s].tolist())
+
+  def trip_coordinates(self, trip):
+    """List of (lon, lat) for each stop on a trip."""
+    stops = self.st_stop[self.stop_times(trip)]
+    return zip(self.stop_lon[stops].tolist(), self.stop_lat[stops].tolist())
+
+  def route_stops(self, route_ids):
+    """Indexes of all stops served by any trip on the given routes."""
+    trips = [self.route_trips[i] for i in route_ids if i in self.route_trips]
+    if not trips:
+      return numpy.zeros(0, dtype=numpy.int32)
+    mask = numpy.in1d(self.st_trip, numpy.concatenate(trips))
+    return numpy.unique(self.st_stop[mask])
+
+  def trip_starts(self):
+    """First arrival of each trip; -1 for trips without stop_times."""
+    starts = numpy.zeros(len(self.trip_id), dtype=numpy.int32) - 1
+    has = self.trip_offsets[1:] > self.trip_offsets[:-1]
+    starts[has] = self.st_arrival[self.trip_offsets[:-1][has]]
+    return starts
+
+  def trip_ends(self):
+    """Last arrival of each trip; -1 for trips without stop_times."""
+    ends = numpy.zeros(len(self.trip_id), dtype=numpy.int32) - 1
+    has = self.trip_offsets[1:] > self.trip_offsets[:-1]
+    ends[has] = self.st_arrival[self.trip_offsets[1:][has] - 1]
+    return ends
+
+  def trip_patterns(self):
+    """Cluster trips by their ordered stop sequence.
+
+    Returns the pattern index of each trip, and the stop indexes of each
+    pattern; each sequence is hashed once, in a single pass over the
+    presorted stop_times.
+    """
+    if not hasattr(self, '_patterns'):
+      seen = {}
+      patterns = []
+      index = numpy.zeros(len(self.trip_id), dtype=numpy.int32)
+      st_stop = numpy.ascontiguousarray(self.st_stop, dtype=numpy.int32)
+      o = self.trip_offsets
+      for trip in range(len(self.trip_id)):
+        key = st_stop[o[trip]:o[trip+1]].tostring()
+        if key not in seen:
+          seen[key] = len(patterns)
+          patterns.append(st_stop[o[trip]:o[trip+1]])
+        index[trip] = seen[key]
+      self._patterns = (index, patterns)
+    return self._patterns
+
+  def schedule(self, trips):
+    """Arrivals of trips on the same stop pattern, as a (trips, stops) array; -1 if missing."""
+    trips = numpy.asarray(trips)
+    stops = self.trip_offsets[trips[0]+1] - self.trip_offsets[trips[0]]
+    return self.st_arrival[self.trip_offsets[trips][:,None] + numpy.arange(stops)]
+
+def checksum(filename):
+  """SHA-1 of a file's contents."""
+  h = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), ''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def open_feed(filename, cache=CACHE):
+  """Open a GTFS .zip or pygtfs sqlite DB as a Feed.
+
+  If cache is set, the preprocessed tables are kept there keyed by the
+  source file's checksum, and later runs on the same file map them back
+  in instead of parsing it again.
+  """
+  path = None
+  if cache:
+    path = os.path.join(cache, checksum(filename))
+    if os.path.exists(os.path.join(path, 'feed.json')):
+      try:
+        with instrument.stage('feed cache load'):
+          return Feed.load(path)
+      except ValueError:
+        shutil.rmtree(path, ignore_errors=True)
+  with instrument.stage('feed load'):
+    if filename.endswith(".db"):
+      import pygtfs
+      sched = pygtfs.Schedule(filename)
+      instrument.count_queries(sched.engine)
+      feed = Feed.from_schedule(sched)
+    else:
+      feed = Feed.from_zip(filename)
+  if path:
+    with instrument.stage('feed cache save'):
+      feed.save(path)
+  return feed
+
+def columns(rows, fields):
+  """Transpose query result rows into named columns."""
+  result = dict((field, []) for field in fields)
+  for row in rows:
+    for field, value in zip(fields, row):
+      result[field].append(value)
+  return result
+
+def text(values):
+  """Query strings as UTF-8 bytes, with '' for NULL."""
+  return [i.encode('utf-8') if isinstance(i, unicode) else ('' if i is None else str(i)) for i in values]
@@ -1,16 +1,34 @@
 """GeoJSON to GTFS."""
-import copy
+import array
+import collections
 import csv
 import datetime
+import itertools
 import os
+import tempfile
+import time
+import zipfile
 import geojson
+import geostream
 import haversine
+import instrument
 import argparse
-import json
+import math
+import multiprocessing
+import numpy
+
+# Rows written per batch, and output file buffer size.
+BATCH = 10000
+BUFFER = 1 << 20
 
 def timefmt(t):
   return t.strftime('%H:%M:%S')  
 
+def clock(t):
+  """Seconds since midnight as GTFS HH:MM:SS; may be past 24:00:00."""
+  t = int(t)
+  return '%02d:%02d:%02d'%(t // 3600, t % 3600 // 60, t % 60)
+
 def minutes(t):
   return datetime.timedelta(minutes=t)
 
@@ -20,6 +38,19 @@ def seconds(t):
 def hours(t):
   return datetime.timedelta(hours=t)
 
+def write_rows(f, header, rows, batch=BATCH):
+  """Write a CSV table in batches of rows; returns the number of rows."""
+  writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+  writer.writerow(header)
+  count = 0
+  rows = iter(rows)
+  while True:
+    chunk = list(itertools.islice(rows, batch))
+    if not chunk:
+      return count
+    writer.writerows(chunk)
+    count += len(chunk)
+
 class StopTime(dict):
   # "trip_id","arrival_time","departure_time","stop_id","stop_sequence","stop_headsign","pickup_type","drop_off_type","shape_dist_traveled"
   pass
@@ -32,6 +63,38 @@ class Trip(dict):
     stop_time = StopTime(arrival_time=arrival_time, departure_time=(departure_time or arrival_time), stop_id=stop_id, stop_sequence=stop_sequence)
     self['stop_times'].append(stop_time)
 
+class Pattern(object):
+  """Trips that share a stop sequence and segment travel times.
+
+  The time offset of each stop from the first is computed once; a trip
+  is then just a start time, in seconds since midnight, and a trip_id.
+  Times are only formatted when written.
+  """
+  def __init__(self, stop_ids, offsets, direction_id=0, service_id=1, trip_headsign="ok"):
+    self.stop_ids = list(stop_ids)
+    self.offsets = numpy.asarray(offsets, dtype=numpy.float64)
+    self.direction_id = direction_id
+    self.service_id = service_id
+    self.trip_headsign = trip_headsign
+    self.starts = array.array('d')
+    # An "anonymous" trip will have an ID assigned at GTFS write time.
+    self.trip_ids = []
+
+  def __len__(self):
+    return len(self.starts)
+
+  def add_trip(self, start, trip_id=None):
+    self.starts.append(start)
+    self.trip_ids.append(trip_id)
+
+  def add_trips(self, starts):
+    self.starts.extend(starts)
+    self.trip_ids.extend([None] * len(starts))
+
+  def arrivals(self, i):
+    """Arrival times at each stop for trip i, in seconds since midnight."""
+    return numpy.floor(self.starts[i] + self.offsets).astype(numpy.int64)
+
 class Stop(geojson.Feature):
   pass
 
@@ -46,159 +109,391 @@ class Route(geojson.Feature):
     ttotal = seconds(0)
     s = [stops[i] for i in stop_ids]
     # Use stop 0 -> stop 0 to set initial stop_time
-    for a,b in zip([s[0]]+s[0:-1], s):
-      d = haversine.haversine(a.geometry.coordinates, b.geometry.coordinates)
+    distances = [0.0] + haversine.segments([i.geometry.coordinates for i in s]).tolist()
+    for b,d in zip(s, distances):
       t = hours(d/speed)
       dtotal += d
       ttotal += t
       # print a['stop_id'], "->", b['stop_id'], "segment:", d, "time:", t, "traveled:", dtotal, "elapsed:", ttotal, "wall:", start+ttotal
       trip.add_stop(stop_id=b.properties['stop_id'], arrival_time=timefmt(start+ttotal))
-    print "-----"
-    print "Total time:", ttotal
-    print "Total distance:", dtotal
+    instrument.log("-----")
+    instrument.log("Total time:", ttotal)
+    instrument.log("Total distance:", dtotal)
     self.properties['trips'].append(trip)
 
+  def add_pattern_speed(self, stop_ids, speed, stops, direction_id=0, distances=None):
+    """Add a Pattern running at a constant speed; add its trips with Pattern.add_trips.
+
+    distances are the cumulative stop distances, if already known.
+    """
+    if 'patterns' not in self.properties:
+      self.properties['patterns'] = []
+    if distances is None:
+      distances = haversine.cumulative([stops[i].geometry.coordinates for i in stop_ids])
+    pattern = Pattern(stop_ids, distances / speed * 3600, direction_id=direction_id)
+    instrument.log("-----")
+    instrument.log("Total time:", seconds(pattern.offsets[-1]))
+    instrument.log("Total distance:", distances[-1])
+    self.properties['patterns'].append(pattern)
+    return pattern
+
+class StopIndex(object):
+  """Grid index of stop locations, for snapping points to nearby stops.
+
+  Points within tolerance (meters) of an indexed stop match it; with a
+  tolerance of 0, only identical coordinates match.
+  """
+  def __init__(self, tolerance=0.0):
+    self.tolerance = tolerance
+    self.exact = {}
+    self.grid = collections.defaultdict(list)
+    # Grid cell size, in degrees of latitude.
+    self.cell = tolerance / 111320.0
+
+  def _cell(self, lon, lat):
+    return (int(math.floor(lon / self.cell)), int(math.floor(lat / self.cell)))
+
+  def add(self, point, stop):
+    point = tuple(point[:2])
+    self.exact[point] = stop
+    if self.tolerance > 0:
+      self.grid[self._cell(*point)].append((point, stop))
+
+  def find(self, point):
+    """The nearest stop within tolerance of point, or None."""
+    point = tuple(point[:2])
+    if point in self.exact or self.tolerance <= 0:
+      return self.exact.get(point)
+    lon, lat = point
+    x, y = self._cell(lon, lat)
+    # Cells are narrower in distance along longitude away from the equator.
+    dx = int(math.ceil(1 / max(math.cos(math.radians(min(abs(lat) + self.cell, 89.0))), 1e-6)))
+    best, nearest = self.tolerance / 1000.0, None
+    for i in range(x - dx, x + dx + 1):
+      for j in range(y - 1, y + 2):
+        for p, stop in self.grid.get((i, j), []):
+          d = haversine.haversine(point, p)
+          if d <= best:
+            best, nearest = d, stop
+    return nearest
+
+def numeric(value):
+  """Integer value of a numeric ID, or None."""
+  if isinstance(value, (int, long)):
+    return value
+  if isinstance(value, basestring) and value.isdigit():
+    return int(value)
+  return None
+
 class Schedule(object):
-  def __init__(self, agency_id, agency_name=None, agency_url="http://www.example.com", agency_timezone="America/Los_Angeles"):
+  def __init__(self, agency_id, agency_name=None, agency_url="http://www.example.com", agency_timezone="America/Los_Angeles", tolerance=0.0):
     self.agency_id = agency_id
     self.agency_name = agency_name or agency_id
     self.agency_url = agency_url
     self.agency_timezone = agency_timezone
     self.routes = {}
     self.stops = {}
-    self.stops_index = {}
+    self.stops_index = StopIndex(tolerance=tolerance)
+    # IDs of stops snapped to another stop, and the stop_id they became.
+    self.aliases = {}
+    # Next IDs to assign; kept above any numeric ID already in use.
+    self._next_stop_id = 1
+    self._next_route_id = 1
+
+  def _allocate(self, name, used):
+    """Allocate the next free numeric stop or route ID."""
+    key = '_next_%s_id'%name
+    value = getattr(self, key)
+    while value in used or str(value) in used:
+      value += 1
+    setattr(self, key, value + 1)
+    return value
+
+  def _reserve(self, name, value):
+    """Keep a numeric ID from being allocated again."""
+    key = '_next_%s_id'%name
+    value = numeric(value)
+    if value is not None and value >= getattr(self, key):
+      setattr(self, key, value + 1)
   
   def add_stop(self, stop):
     """Add a stop to the schedule."""
     p = tuple(stop.geometry['coordinates'])
-    if p in self.stops_index:
-      return self.stops_index[p]
-    stop.properties['stop_id'] = stop.properties.get('stop_id') or max([0]+self.stops.keys()) + 1
+    match = self.stops_index.find(p)
+    if match is not None:
+      stop_id = stop.properties.get('stop_id')
+      if stop_id and stop_id != match.properties['stop_id']:
+        self.aliases[stop_id] = match.properties['stop_id']
+      return match
+    stop.properties['stop_id'] = stop.properties.get('stop_id') or self._allocate('stop', self.stops)
     if stop.properties['stop_id'] in self.stops:
       return self.stops[stop.properties['stop_id']]
     #
+    self._reserve('stop', stop.properties['stop_id'])
     stop.properties['stop_name'] = stop.properties.get('stop_name') or stop.properties['stop_id']
     self.stops[stop.properties['stop_id']] = stop
-    self.stops_index[p] = stop
+    self.stops_index.add(p, stop)
     return stop
   
   def add_route(self, route):
     """Add a route to the schedule."""
-    route.properties['route_id'] = route.properties.get('route_id') or max([0]+self.routes.keys()) + 1
+    route.properties['route_id'] = route.properties.get('route_id') or self._allocate('route', self.routes)
     if route.properties['route_id'] in self.routes:
       return self.routes[route.properties['route_id']]
     #
+    self._reserve('route', route.properties['route_id'])
     route.properties['route_short_name'] = route.properties.get('route_short_name') or route.properties['route_id']
     route.properties['route_long_name'] = route.properties.get('route_long_name') or route.properties['route_id']
-    if not route.properties.get('stop_ids'):
+    if route.properties.get('stop_ids'):
+      route.properties['stop_ids'] = [self.aliases.get(i, i) for i in route.properties['stop_ids']]
+    else:
       route.properties['stop_ids'] = [self.add_stop(Stop(geometry=geojson.Point(stop))).properties['stop_id'] for stop in route.geometry.coordinates]
     self.routes[route.properties['route_id']] = route
     return route
   
   def _assign_trip_ids(self):
     """Assign trip_ids where missing."""
-    all_trip_ids = []
+    count = 0
     for route in self.routes.values():
-      all_trip_ids += [i['trip_id'] for i in route.properties['trips']]
-    all_trip_ids = filter(None, all_trip_ids)
-    count = max([0]+all_trip_ids) + 1
+      for trip_id in itertools.chain((i['trip_id'] for i in route.properties.get('trips', [])), *[i.trip_ids for i in route.properties.get('patterns', [])]):
+        count = max(count, numeric(trip_id) or 0)
+    count += 1
     for route in self.routes.values():
-      for trip in route.properties['trips']:
+      for trip in route.properties.get('trips', []):
         if trip['trip_id'] is None:
           trip['trip_id'] = count
           count += 1
+      for pattern in route.properties.get('patterns', []):
+        for i, trip_id in enumerate(pattern.trip_ids):
+          if trip_id is None:
+            pattern.trip_ids[i] = count
+            count += 1
   
+  def _routes(self):
+    return [route for _, route in sorted(self.routes.items())]
+
+  def _trip_rows(self):
+    for route in self._routes():
+      route_id = route.properties['route_id']
+      for trip in route.properties.get('trips', []):
+        yield [route_id, trip['service_id'], trip['trip_id'], trip['trip_headsign'] or route.properties['route_short_name'], trip['direction_id'], ""]
+      for pattern in route.properties.get('patterns', []):
+        headsign = pattern.trip_headsign or route.properties['route_short_name']
+        for trip_id in pattern.trip_ids:
+          yield [route_id, pattern.service_id, trip_id, headsign, pattern.direction_id, ""]
+
+  def _stop_time_rows(self):
+    # Formatted times, shared between trips.
+    clocks = {}
+    for route in self._routes():
+      for trip in route.properties.get('trips', []):
+        # arrival_time, departure_time or arrival_time, stop_id, stop_sequence
+        for i in trip['stop_times']:
+          yield [trip['trip_id'], i['arrival_time'], i['departure_time'], i['stop_id'], i['stop_sequence'], "", "", "", ""]
+      for pattern in route.properties.get('patterns', []):
+        sequences = range(1, len(pattern.stop_ids) + 1)
+        for i, trip_id in enumerate(pattern.trip_ids):
+          for sequence, stop_id, t in zip(sequences, pattern.stop_ids, pattern.arrivals(i).tolist()):
+            if t not in clocks:
+              clocks[t] = clock(t)
+            yield [trip_id, clocks[t], clocks[t], stop_id, sequence, "", "", "", ""]
+
+  def tables(self):
+    """Yield (filename, header, rows) for each GTFS table; rows are generated lazily."""
+    yield 'agency.txt', ["agency_id", "agency_name", "agency_url", "agency_timezone"], [
+      [self.agency_id, self.agency_name, self.agency_url, self.agency_timezone]
+    ]
+    yield 'calendar.txt', ["service_id","monday","tuesday","wednesday","thursday","friday","saturday","sunday","start_date","end_date"], [
+      ["1","1","1","1","1","1","1","1","20100101","20200101"]
+    ]
+    yield 'fare_attributes.txt', ["fare_id","price","currency_type","payment_method","transfers","transfer_duration"], [
+      ["1","2","USD","0","0",""]
+    ]
+    yield 'fare_rules.txt', ["fare_id","route_id","origin_id","destination_id","contains_id"], (
+      ["1", route.properties['route_id'], "", "", ""] for route in self._routes()
+    )
+    yield 'routes.txt', ["route_id","agency_id","route_short_name","route_long_name","route_desc","route_type","route_url","route_color","route_text_color"], (
+      [route.properties['route_id'], self.agency_id, "", route.properties['route_short_name'], route.properties['route_long_name'], "3", "", "", ""] for route in self._routes()
+    )
+    yield 'trips.txt', ["route_id","service_id","trip_id","trip_headsign","direction_id","block_id"], self._trip_rows()
+    yield 'stop_times.txt', ["trip_id","arrival_time","departure_time","stop_id","stop_sequence","stop_headsign","pickup_type","drop_off_type","shape_dist_traveled"], self._stop_time_rows()
+    yield 'stops.txt', ["stop_id","stop_name","stop_desc","stop_lat","stop_lon","zone_id"], (
+      [stop.properties['stop_id'], stop.properties['stop_name'], '', stop.geometry['coordinates'][1], stop.geometry['coordinates'][0], '1'] for _, stop in sorted(self.stops.items())
+    )
+
   def write(self, path='.'):
-    """Write GTFS output."""
+    """Write GTFS output to a directory, or straight into a .zip feed."""
     self._assign_trip_ids()
-    
-    # Write results.
-    with open(os.path.join(path, 'agency.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["agency_id", "agency_name", "agency_url", "agency_timezone"])
-      writer.writerow([self.agency_id, self.agency_name, self.agency_url, self.agency_timezone])
-  
-    with open(os.path.join(path, 'calendar.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["service_id","monday","tuesday","wednesday","thursday","friday","saturday","sunday","start_date","end_date"])
-      writer.writerow(["1","1","1","1","1","1","1","1","20100101","20200101"])
-
-    with open(os.path.join(path, 'fare_attributes.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["fare_id","price","currency_type","payment_method","transfers","transfer_duration"])
-      writer.writerow(["1","2","USD","0","0",""])
-
-    with open(os.path.join(path, 'fare_rules.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["fare_id","route_id","origin_id","destination_id","contains_id"])
-      for route in self.routes.values():
-        writer.writerow(["1", route.properties['route_id'], "", "", ""])
-
-    with open(os.path.join(path, 'routes.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["route_id","agency_id","route_short_name","route_long_name","route_desc","route_type","route_url","route_color","route_text_color"])
-      for route in self.routes.values():
-        writer.writerow([route.properties['route_id'], self.agency_id, "", route.properties['route_short_name'], route.properties['route_long_name'], "3", "", "", ""])
-
-    with open(os.path.join(path, 'trips.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["route_id","service_id","trip_id","trip_headsign","direction_id","block_id"])
-      for route in self.routes.values():      
-        for trip in route.properties['trips']:
-          writer.writerow([route.properties['route_id'], trip['service_id'], trip['trip_id'], trip['trip_headsign'] or route['route_short_name'], trip['direction_id'], ""])
-
-    with open(os.path.join(path, 'stop_times.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["trip_id","arrival_time","departure_time","stop_id","stop_sequence","stop_headsign","pickup_type","drop_off_type","shape_dist_traveled"])
-      for route in self.routes.values():      
-        for trip in route.properties['trips']:
-          # arrival_time, departure_time or arrival_time, stop_id, stop_sequence
-          for i in trip['stop_times']:
-            writer.writerow([trip['trip_id'], i['arrival_time'], i['departure_time'], i['stop_id'], i['stop_sequence'], "", "", "", ""])
-            
-    with open(os.path.join(path, 'stops.txt'), 'wb') as f:
-      writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-      writer.writerow(["stop_id","stop_name","stop_desc","stop_lat","stop_lon","zone_id"])
-      for stop in self.stops.values():
-        writer.writerow([stop.properties['stop_id'], stop.properties['stop_name'], '', stop.geometry['coordinates'][1], stop.geometry['coordinates'][0], '1'])
+    zf = None
+    if path.endswith('.zip'):
+      zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+      for filename, header, rows in self.tables():
+        t = time.time()
+        if zf:
+          # Stage each table in a temporary file, then add it to the zip.
+          fd, tmp = tempfile.mkstemp(suffix='.txt')
+          try:
+            with os.fdopen(fd, 'wb', BUFFER) as f:
+              count = write_rows(f, header, rows)
+            zf.write(tmp, filename)
+          finally:
+            os.remove(tmp)
+        else:
+          with open(os.path.join(path, filename), 'wb', BUFFER) as f:
+            count = write_rows(f, header, rows)
+        t = time.time() - t
+        instrument.profiler.add('csv write', t)
+        instrument.count('rows', count)
+        print "Wrote %s: %s rows in %0.2fs (%d rows/sec)"%(filename, count, t, count / max(t, 1e-6))
+    finally:
+      if zf:
+        zf.close()
+
+
+
+##### Scenarios #####
+
+# Default service span, in seconds since midnight.
+START = 5 * 3600
+END = 20 * 3600
+
+def read_network(filename, agency_id, tolerance=0.0):
+  """Read a GeoJSON network into a Schedule's stops and routes."""
+  sched = Schedule(agency_id=agency_id, tolerance=tolerance)
+
+  # Read the geoJSON file one feature at a time: add stops as they
+  # arrive, and queue routes until all the stops are known.
+  routes = collections.deque()
+  with instrument.stage('read input'), geostream.open_input(filename) as f:
+    for i in geostream.iter_features(f):
+      if i['geometry']['type'] == 'Point':
+        # Add stop
+        sched.add_stop(Stop(**i))
+      elif i['geometry']['type'] == 'LineString':
+        # Service is generated from headway and speed; drop trips carried
+        # over from an export, e.g. gtfs_geojson.py --trips.
+        (i.get('properties') or {}).pop('trips', None)
+        routes.append(i)
+
+  with instrument.stage('topology'):
+    while routes:
+      # Check all stops exist
+      sched.add_route(Route(**routes.popleft()))
+  return sched
+
+def route_distances(sched):
+  """Cumulative stop distances along each route: {route_id: (forward, reverse)}."""
+  distances = {}
+  with instrument.stage('distances'):
+    for route_id, route in sched.routes.items():
+      coords = [sched.stops[i].geometry.coordinates for i in route.properties['stop_ids']]
+      distances[route_id] = (haversine.cumulative(coords), haversine.cumulative(coords[::-1]))
+  return distances
 
+def add_service(sched, distances, start=START, end=END, headway=None, speed=None):
+  """Replace each route's patterns: one per direction, and a trip per headway.
+
+  headway and speed default to each route's own properties.
+  """
+  with instrument.stage('patterns'):
+    for route_id, route in sched.routes.items():
+      h = headway or route.properties.get('headway')
+      v = speed or route.properties.get('speed')
+      instrument.log("Route: %s, speed: %s, headway: %s"%(route_id, v, seconds(h)))
+      starts = numpy.arange(start, end + h, h)
+      starts = starts[starts <= end]
+      forward, reverse = distances[route_id]
+      route.properties['patterns'] = []
+      route.add_pattern_speed(stop_ids=route.properties['stop_ids'], direction_id=0, speed=v, stops=sched.stops, distances=forward).add_trips(starts)
+      route.add_pattern_speed(stop_ids=route.properties['stop_ids'][::-1], direction_id=1, speed=v, stops=sched.stops, distances=reverse).add_trips(starts)
+
+def scenarios(headways, speeds, spans):
+  """Every combination of headway, speed and (start, end) span, with a name."""
+  label = lambda x:'route' if x is None else '%g'%x
+  for headway, speed, (start, end) in itertools.product(headways, speeds, spans):
+    yield {
+      'name': 'headway-%s_speed-%s_span-%s-%s'%(label(headway), label(speed), label(start / 3600.0), label(end / 3600.0)),
+      'headway': headway,
+      'speed': speed,
+      'start': start,
+      'end': end
+    }
+
+# The network shared with worker processes; set before the pool forks.
+_batch = {}
+
+def write_scenario(sched, distances, output, scenario):
+  """Replace the schedule's patterns with a scenario's, and write it to output."""
+  add_service(sched, distances, start=scenario['start'], end=scenario['end'], headway=scenario['headway'], speed=scenario['speed'])
+  sched.write(path=os.path.join(output, '%s.zip'%scenario['name']))
+  return scenario
+
+def _scenario_worker(scenario):
+  """Write one scenario in a worker process; returns the stats to merge."""
+  instrument.profiler.reset()
+  write_scenario(_batch['sched'], _batch['distances'], _batch['output'], scenario)
+  return scenario, instrument.profiler.stats()
+
+def write_scenarios(sched, distances, output, scenarios, jobs=1):
+  """Write a GTFS .zip to output for each scenario, jobs at a time.
+
+  Each worker process gets its own copy of the network, so only the
+  patterns and trips are built per scenario.
+  """
+  if not os.path.exists(output):
+    os.makedirs(output)
+  if jobs <= 1:
+    for scenario in scenarios:
+      write_scenario(sched, distances, output, scenario)
+      print "Scenario %s: %s.zip"%(scenario['name'], os.path.join(output, scenario['name']))
+    return
+  _batch.update(sched=sched, distances=distances, output=output)
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for scenario, stats in pool.imap_unordered(_scenario_worker, scenarios):
+      instrument.profiler.merge(stats)
+      print "Scenario %s: %s.zip"%(scenario['name'], os.path.join(output, scenario['name']))
+  finally:
+    pool.close()
+    pool.join()
+    _batch.clear()
+
+def numbers(value, parse=float):
+  """Parse a comma separated list."""
+  return [parse(i) for i in value.split(",")]
+
+def span(value):
+  """Parse a service span in hours, "5-20", into seconds since midnight."""
+  start, end = value.split("-")
+  return int(float(start) * 3600), int(float(end) * 3600)
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("agency")
-  parser.add_argument("filename", help="GTFS geojson")
-  parser.add_argument("output", help="GTFS output directory")
+  parser.add_argument("filename", help="GTFS geojson: FeatureCollection or newline-delimited; may be .gz")
+  parser.add_argument("output", help="GTFS output directory, or .zip file; with scenarios, a directory of .zip files")
+  parser.add_argument("--snap", help="Merge stops and route vertices within this many meters", default=0.0, type=float)
+  parser.add_argument("--headways", help="Scenarios: comma separated headways, in seconds; overrides the route headway")
+  parser.add_argument("--speeds", help="Scenarios: comma separated speeds, in km/h; overrides the route speed")
+  parser.add_argument("--spans", help="Scenarios: comma separated service spans, in hours, e.g. 5-20,6-24")
+  parser.add_argument("--jobs", help="Scenarios to write in parallel", default=multiprocessing.cpu_count(), type=int)
+  instrument.add_arguments(parser)
   args = parser.parse_args()
+  instrument.setup(args)
+
+  # Stops, routes and segment distances are shared by every scenario.
+  sched = read_network(args.filename, args.agency, tolerance=args.snap)
+  distances = route_distances(sched)
 
-  # Read the geoJSON file, create the stops and routes.  
-  with open(args.filename) as f:
-    data = json.load(f)
-
-  # Filter
-  stops = [Stop(**i) for i in data['features'] if i['geometry']['type'] == 'Point']
-  routes = [Route(**i) for i in data['features'] if i['geometry']['type'] == 'LineString']
-
-  sched = Schedule(agency_id=args.agency)
-  for stop in stops:
-    # Add stop
-    sched.add_stop(stop)
-
-  for route in routes:
-    # Check all stops exist
-    sched.add_route(route)
-
-  start = datetime.datetime.now().replace(hour=5, minute=0, second=0, microsecond=0)
-  end = datetime.datetime.now().replace(hour=20, minute=0, second=0, microsecond=0)
-
-  # Add trips
-  for route in sched.routes.values():
-    headway = seconds(route.properties.get('headway'))
-    speed = route.properties.get('speed')
-    now = copy.copy(start)
-    print "Route: %s, speed: %s, headway: %s"%(route.properties['route_id'], speed, headway)
-    while now <= end:
-      route.add_trip_speed(route_id=route.properties['route_id'], stop_ids=route.properties['stop_ids'], direction_id=0, start=now, speed=speed, stops=sched.stops)
-      route.add_trip_speed(route_id=route.properties['route_id'], stop_ids=route.properties['stop_ids'][::-1], direction_id=1, start=now, speed=speed, stops=sched.stops)
-      now += headway
-
-  sched.write(path=args.output)
+  if args.headways or args.speeds or args.spans:
+    grid = scenarios(
+      numbers(args.headways) if args.headways else [None],
+      numbers(args.speeds) if args.speeds else [None],
+      map(span, args.spans.split(",")) if args.spans else [(START, END)]
+    )
+    write_scenarios(sched, distances, args.output, list(grid), jobs=args.jobs)
+  else:
+    add_service(sched, distances)
+    sched.write(path=args.output)
+  instrument.finish(args)
@@ -0,0 +1,143 @@
+"""Streaming GeoJSON input and output."""
+import gzip
+import json
+
+# Bytes read at a time by the incremental parser.
+CHUNK = 1 << 16
+WHITESPACE = ' \t\n\r\x1e'
+
+def open_input(filename):
+  """Open an input file; gzip compressed if it ends in .gz"""
+  if filename.endswith('.gz'):
+    return gzip.open(filename, 'rb')
+  return open(filename, 'rb')
+
+def open_output(filename):
+  """Open an output file for writing; gzip compressed if it ends in .gz"""
+  if filename.endswith('.gz'):
+    return gzip.open(filename, 'wb')
+  return open(filename, 'wb')
+
+def dumps(feature):
+  """Serialize a feature, unless it is already GeoJSON text."""
+  if isinstance(feature, basestring):
+    return feature
+  return json.dumps(feature)
+
+class FeatureWriter(object):
+  """Write features one at a time, so only one is in memory at once.
+
+  Writes a FeatureCollection, with the wrapper written incrementally, or
+  with ndjson=True, newline-delimited GeoJSON: one feature per line.
+  """
+  def __init__(self, f, ndjson=False):
+    self.f = f
+    self.ndjson = ndjson
+    self.count = 0
+    if not self.ndjson:
+      self.f.write('{"type": "FeatureCollection", "features": [')
+
+  def write(self, feature):
+    if self.ndjson:
+      self.f.write(dumps(feature))
+      self.f.write('\n')
+    else:
+      if self.count:
+        self.f.write(', ')
+      self.f.write(dumps(feature))
+    self.count += 1
+
+  def close(self):
+    if not self.ndjson:
+      self.f.write(']}')
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class Reader(object):
+  """Incremental JSON reader over a file, one value at a time."""
+  def __init__(self, f):
+    self.f = f
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _fill(self):
+    """Read more input; returns False at end of file."""
+    if self.eof:
+      return False
+    # Drop what has been consumed, and read at least as much as is buffered.
+    self.buf = self.buf[self.pos:]
+    self.pos = 0
+    data = self.f.read(max(CHUNK, len(self.buf)))
+    if not data:
+      self.eof = True
+      return False
+    self.buf += data
+    return True
+
+  def peek(self):
+    """The next non-whitespace character, or None at end of input."""
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self._fill():
+        return None
+
+  def expect(self, c):
+    if self.peek() != c:
+      raise ValueError("Expected %r at offset %s"%(c, self.pos))
+    self.pos += 1
+
+  def value(self):
+    """Decode the next complete JSON value."""
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # A number at the end of the buffer may continue in the next chunk.
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except ValueError:
+        if self.eof:
+          raise
+      self._fill()
+
+def iter_features(f):
+  """Yield features from a FeatureCollection or newline-delimited GeoJSON.
+
+  Features in a FeatureCollection's "features" array are decoded one at a
+  time, so the whole collection is never in memory at once; top-level
+  Feature objects (one per line, or concatenated) are yielded as-is.
+  """
+  r = Reader(f)
+  while r.peek() is not None:
+    r.expect('{')
+    obj = {}
+    while r.peek() != '}':
+      if r.peek() == ',':
+        r.pos += 1
+        continue
+      key = r.value()
+      r.expect(':')
+      if key != 'features' or r.peek() != '[':
+        obj[key] = r.value()
+        continue
+      r.expect('[')
+      while r.peek() != ']':
+        if r.peek() == ',':
+          r.pos += 1
+          continue
+        yield r.value()
+      r.expect(']')
+    r.expect('}')
+    if obj.get('type') == 'Feature':
+      yield obj
@@ -1,45 +1,107 @@
 """GTFS to GeoJSON."""
 import collections
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
 import numpy
 import json
 import argparse
 import pprint
 
-# PyGTFS is required.
-import pygtfs
 # frewsxcv/python-geojson
 import geojson
 
-def route_from_stops(stops, planner):
+import feed as gtfsfeed
+import geostream
+import instrument
+import los
+import segcache
+import tiles
+
+# One trip planner client per thread.
+_planners = threading.local()
+
+def plan_segment(planner, start, end):
   import cityism.planner
+  if getattr(_planners, planner, None) is None:
+    setattr(_planners, planner, cityism.planner.getplanner(planner))
+  instrument.count('planner calls')
+  with instrument.stage('planner'):
+    a, _ = getattr(_planners, planner).plan(start=start, end=end)
+  return a
+
+def route_from_stops(stops, planner, cache=None):
   # Flip from lon/lat -> lat/lon
   route = []
-  otp = cityism.planner.getplanner(planner)
+  segments = segcache.open_cache(cache) if cache else None
   flip = map(lambda x:(x[1],x[0]), stops)
-  for i in range(len(flip)-1):
-    start = flip[i]
-    end = flip[i+1]
-    a, _ = otp.plan(start=start, end=end)
-    route.extend(a)  
+  try:
+    for i in range(len(flip)-1):
+      start = flip[i]
+      end = flip[i+1]
+      a = segments.get(planner, start, end) if segments else None
+      if a is None:
+        a = plan_segment(planner, start, end)
+        if segments:
+          segments.put(planner, start, end, a)
+      else:
+        instrument.count('planner cache hits')
+      route.extend(a)
+  finally:
+    if segments:
+      segments.commit()
   return route
 
+def plan_segments(routes, feed, planner, cache, jobs=8):
+  """Plan every uncached stop-to-stop segment of routes without shapes.
+
+  Segments shared between routes and directions are planned once, and
+  up to jobs requests are made to the planner at a time.
+  """
+  segments = segcache.open_cache(cache)
+  try:
+    todo = set()
+    for route in routes:
+      for key, trips in route_groups(route, feed):
+        if feed.trip_shape[trips[0]] and feed.shape(feed.trip_shape[trips[0]]):
+          continue
+        flip = [(lat,lon) for lon,lat in feed.trip_coordinates(trips[0])]
+        for start, end in zip(flip[:-1], flip[1:]):
+          if (start, end) not in todo and segments.get(planner, start, end) is None:
+            todo.add((start, end))
+    todo = sorted(todo)
+    print "Planning %s segments"%len(todo)
+    if not todo:
+      return
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+      for (start, end), a in zip(todo, pool.imap(lambda x:plan_segment(planner, *x), todo)):
+        segments.put(planner, start, end, a)
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    # Commit on every path, so forked workers never wait on our lock.
+    segments.commit()
+
 ##### Routes #####
   
-def route_as_geo(route, trips, properties=None, sched=None, planner=None):
+def route_as_geo(route, trips, properties=None, feed=None, planner=None, cache=None):
   points = []
   # Check if we have shapes.txt...
   trip = trips[0]
-  if trip.shape_id:
-    # Ok, hacky patch to pygtfs to pull it out of the sqlite-sqlalchemy db.
-    q = sched.session.query(pygtfs.gtfs_entities.ShapePoint).filter_by(shape_id=trip.shape_id)
-    for stop in q.all():
-      points.append((stop.shape_pt_lon, stop.shape_pt_lat))
+  with instrument.stage('shape fetch'):
+    shape = feed.shape(feed.trip_shape[trip]) if feed.trip_shape[trip] else None
+  if shape:
+    points.extend(shape)
   else:
     # Otherwise, reconstruct the route based on stop locations.
-    stops = [(stop.stop.stop_lon, stop.stop.stop_lat) for stop in trip.stop_times]
+    stops = feed.trip_coordinates(trip)
     if planner:
       # Try to use a trip planner
-      stops = route_from_stops(stops, planner=planner)
+      stops = route_from_stops(stops, planner=planner, cache=cache)
     for lon,lat in stops:
       # Otherwise, just a simple line
       points.append((lon,lat))
@@ -47,119 +109,231 @@ def route_as_geo(route, trips, properties=None, sched=None, planner=None):
   f = geojson.Feature(properties=properties, geometry=geojson.LineString(points))
   return f
 
-def stop_as_geo(stop):
-  # f = geojson.Feature(name=str(stop), typegeom='Point')
-  return geojson.Feature(geometry=geojson.Point((stop.stop_lon, stop.stop_lat)), properties={'name':str(stop), 'stop_id':stop.stop_id})
+def stop_as_geo(stop, feed):
+  return geojson.Feature(geometry=geojson.Point((feed.stop_lon[stop], feed.stop_lat[stop])), properties={'name':feed.stop_name[stop], 'stop_id':feed.stop_id[stop]})
+
     
 ##### Main #####
+
+# Bump when the exported features change, so old exports are not reused.
+EXPORT_VERSION = 2
+
+def route_fingerprint(route, feed, planner=None, includetrips=False):
+  """Hash of everything a route's exported features depend on.
+
+  Covers the route itself, its trips, their stop_times and stops, the
+  shapes they use, their service, and the export options.
+  """
+  h = hashlib.sha1(json.dumps([EXPORT_VERSION, route, planner, includetrips], sort_keys=True))
+  trips = numpy.sort(feed.route_trips.get(route['route_id'], numpy.zeros(0, dtype=int)))
+  for column in [feed.trip_id, feed.trip_service, feed.trip_shape, feed.trip_headsign, feed.trip_direction]:
+    h.update(numpy.ascontiguousarray(column[trips]).tostring())
+  h.update(numpy.in1d(feed.trip_service[trips], list(feed.services)).tostring())
+  # The trips' stop_times rows, in trip order: each trip's run of rows.
+  lengths = feed.trip_offsets[trips+1] - feed.trip_offsets[trips]
+  st = numpy.arange(lengths.sum()) + numpy.repeat(feed.trip_offsets[trips] - (numpy.cumsum(lengths) - lengths), lengths)
+  stops = feed.st_stop[st]
+  for column in [feed.st_sequence[st], feed.st_arrival[st], feed.stop_id[stops], feed.stop_name[stops], feed.stop_lon[stops], feed.stop_lat[stops]]:
+    h.update(numpy.ascontiguousarray(column).tostring())
+  for shape_id in sorted(set(feed.trip_shape[trips])):
+    h.update(json.dumps([shape_id, feed.shape(shape_id)]))
+  return h.hexdigest()
+
+def previous_features(filename):
+  """Route features from an earlier export, as GeoJSON text by route fingerprint."""
+  previous = collections.defaultdict(list)
+  with geostream.open_input(filename) as f:
+    for feature in geostream.iter_features(f):
+      fingerprint = (feature.get('properties') or {}).get('route_fingerprint')
+      if fingerprint:
+        previous[fingerprint].append(json.dumps(feature))
+  return previous
   
-def route_info(route, sched=None, planner=False, includetrips=False):
-  print "\n===== Route %s: %s ====="%(route.route_short_name, route.route_long_name)
-  
+def route_groups(route, feed):
+  """Group a route's Monday trips by shape, direction and stop pattern.
+
+  Groups are in order of first departure, and their trips are sorted by
+  first arrival.
+  """
+  with instrument.stage('grouping'):
+    return _route_groups(route, feed)
+
+def _route_groups(route, feed):
+  # Stop patterns are hashed once for the whole feed.
+  patterns, _ = feed.trip_patterns()
+  trips = feed.route_trips.get(route['route_id'], numpy.zeros(0, dtype=int))
   # Filter by Monday service for now...
-  trips = filter(lambda x:getattr(x.service, 'monday', None), route.trips)
-    
-  # Find each route by the sequence of stops...
-  unfurled = {}
-  for trip in trips:
-    trip.stop_times = sorted(trip.stop_times, key=lambda x:x.stop_sequence)
-    # s = tuple(i.stop_id for i in trip.stop_times)
-    # s = trip.direction_id
-    s = (trip.shape_id, trip.direction_id)
-    if s not in unfurled:
-      unfurled[s] = []
-    unfurled[s].append(trip)
-
-  for key,trips in unfurled.items():
-    trips = sorted(trips, key=lambda trip:(trip.stop_times[0].arrival_time.seconds))
-    print "----- Route Group -----"
-    print key
-    test_shape_id = set([trip.shape_id for trip in trips])
-    test_headsign = set([trip.trip_headsign for trip in trips])
-    test_times = [str(trip.stop_times[0].arrival_time) for trip in trips]
-
-    # Make sure all headsigns and shapes match
-    try:
-      assert len(test_shape_id) == 1
-    except AssertionError:
-      print "Warning: More than one shape_id!"
-    try:
-      assert len(test_headsign) == 1
-    except AssertionError:
+  trips = trips[numpy.in1d(feed.trip_service[trips], list(feed.services)) & (feed.trip_offsets[trips+1] > feed.trip_offsets[trips])]
+  trips = trips[numpy.argsort(feed.st_arrival[feed.trip_offsets[trips]], kind='mergesort')]
+  groups = collections.OrderedDict()
+  for trip in trips.tolist():
+    key = (feed.trip_shape[trip] or None, feed.direction(trip), int(patterns[trip]))
+    groups.setdefault(key, []).append(trip)
+  return [(k, numpy.array(group)) for k, group in groups.items()]
+
+def route_info(route, feed=None, planner=False, includetrips=False, cache=None, fingerprint=None):
+  print "\n===== Route %s: %s ====="%(route['route_short_name'], route['route_long_name'])
+  fingerprint = fingerprint or route_fingerprint(route, feed, planner=planner, includetrips=includetrips)
+
+  for key,trips in route_groups(route, feed):
+    instrument.log("----- Route Group -----")
+    instrument.log(key)
+    # Shape and stop pattern are part of the key; headsigns may still differ.
+    if len(numpy.unique(feed.trip_headsign[trips])) > 1:
       print "Warning: More than one headsign!"
-      
-    # Include the trip schedule.
-    # Since stop sequence is identical, just store times
-    # Trip start times
+
     r = {}
-    r['route_type'] = route.route_type
-    r['agency_id'] = route.agency_id
-    r['route_desc'] = route.route_desc
-    r['route_long_name'] = route.route_long_name
-    r['route_short_name'] = route.route_short_name
-    r['route_shape_id'] = trips[0].shape_id
-    r['trip_headsign'] = trips[0].trip_headsign
-    r['direction_id'] = trips[0].direction_id
-    
+    r['group_id'] = ':'.join(['' if i is None else str(i) for i in (route['route_id'],)+key])
+    r['route_id'] = route['route_id']
+    r['route_fingerprint'] = fingerprint
+    r['route_type'] = route['route_type']
+    r['agency_id'] = route['agency_id']
+    r['route_desc'] = route['route_desc']
+    r['route_long_name'] = route['route_long_name']
+    r['route_short_name'] = route['route_short_name']
+    r['route_shape_id'] = feed.trip_shape[trips[0]] or None
+    r['trip_headsign'] = feed.trip_headsign[trips[0]]
+    r['direction_id'] = feed.direction(trips[0])
+    r['pattern_id'] = key[-1]
+
+    # Every trip in the group stops at the same stops, so the schedule is
+    # the stop list once, plus each trip's start and time offsets.
+    schedule = feed.schedule(trips)
+    starts = schedule[:,0]
+    r['trip_starts'] = starts.tolist()
+
+    # Level of Service index: cumulative departures by time of day.
+    r.update(los.index(starts[starts >= 0]))
+
     if includetrips:
-      r['trips'] = []
-      for trip in trips:
-        t = {'trip_id': trip.trip_id, 'service_id': trip.service_id, 'trip_headsign': trip.trip_headsign, 'direction_id': trip.direction_id}
-        t['stop_times'] = [{'arrival_time':getattr(stop.arrival_time, 'seconds', None), 'stop_id':stop.stop_id, 'stop_sequence':stop.stop_sequence} for stop in trip[0].stop_times]
-        r['trips'].append(t)
-    #   r['route_stops']    = [stop.stop_id for stop in trips[0].stop_times]
-    #   r['route_schedule'] = [[getattr(stop.arrival_time, 'seconds', None) for stop in trip.stop_times] for trip in trips]
-    #   r['trip_starts'] = [trip.stop_times[0].arrival_time.seconds for trip in trips]
+      r['route_stops'] = feed.stop_id[feed.st_stop[feed.stop_times(trips[0])]].tolist()
+      r['trip_ids'] = feed.trip_id[trips].tolist()
+      offsets = numpy.where((schedule >= 0) & (starts[:,None] >= 0), schedule - starts[:,None], -1)
+      r['route_schedule'] = [[None if t < 0 else t for t in row] for row in offsets.tolist()]
+
+    yield route_as_geo(route=route, trips=trips, properties=r, feed=feed, planner=planner, cache=cache)
+
+
+# Arguments shared with worker processes; set before the pool forks.
+_worker = {}
 
-    yield route_as_geo(route=route, trips=trips, properties=r, sched=sched, planner=planner)
+def export_route(route, **kwargs):
+  """A route's features as GeoJSON text; kwargs are passed to route_info."""
+  features = []
+  for f in route_info(route, **kwargs):
+    with instrument.stage('serialization'):
+      features.append(geojson.dumps(f))
+  return features
 
+def _route_worker(args):
+  """Export one (route, fingerprint) in a worker process; returns its features, and the stats to merge."""
+  route, fingerprint = args
+  instrument.profiler.reset()
+  return export_route(route, fingerprint=fingerprint, **_worker), instrument.profiler.stats()
+
+def _merge(results):
+  for features, stats in results:
+    instrument.profiler.merge(stats)
+    yield features
+
+def export_routes(routes, feed, planner=None, includetrips=False, jobs=1, text=False, cache=None, previous=None):
+  """Yield the route group features for each route, in route order.
+
+  With jobs > 1, routes are fanned out to a pool of processes that share
+  the (read-only) feed, and the results are merged back in order. With
+  text=True, features are yielded already serialized as GeoJSON. Routes
+  whose fingerprint is in previous (see previous_features) reuse those
+  features instead of being exported again.
+  """
+  previous = previous or {}
+  # Each route's fingerprint is computed once, and passed on to route_info.
+  with instrument.stage('fingerprint'):
+    fingerprints = [route_fingerprint(route, feed, planner=planner, includetrips=includetrips) for route in routes]
+  reuse = [previous.get(fingerprint) for fingerprint in fingerprints]
+  changed = [(route, fingerprint) for route, fingerprint, features in zip(routes, fingerprints, reuse) if features is None]
+  if previous:
+    print "Reusing %s routes, exporting %s changed routes"%(len(routes) - len(changed), len(changed))
+  if jobs <= 1:
+    exported = (export_route(route, feed=feed, planner=planner, includetrips=includetrips, cache=cache, fingerprint=fingerprint) for route, fingerprint in changed)
+  else:
+    _worker.update(feed=feed, planner=planner, includetrips=includetrips, cache=cache)
+    pool = multiprocessing.Pool(jobs)
+    exported = _merge(pool.imap(_route_worker, changed))
+  try:
+    # Splice the exported routes back in between the reused ones.
+    for features in reuse:
+      for f in features if features is not None else next(exported):
+        yield f if text else geojson.loads(f)
+  finally:
+    if jobs > 1:
+      pool.close()
+      pool.join()
+      _worker.clear()
     
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("filename", help="GTFS .zip file, or cached sqlite DB.")
-  parser.add_argument("--output", help="GeoJSON output file.")
+  parser.add_argument("--output", help="GeoJSON output file; gzip compressed if it ends in .gz")
+  parser.add_argument("--ndjson", help="Write newline-delimited GeoJSON", action="store_true")
+  parser.add_argument("--tiles", help="Also write simplified, multi-resolution route tiles to this directory")
+  parser.add_argument("--zooms", help="Tile pyramid zoom levels", default=",".join(map(str, tiles.ZOOMS)))
   parser.add_argument("--route", help="Run for route; helpful for debugging.", action="append")
   parser.add_argument("--stops", help="Include stopss in output.", action="store_true")
   parser.add_argument("--exclude", help="Exclude routes", action="append")
   parser.add_argument("--planner", help="Reconstruct routes using a trip planner: osrm or otp")
+  parser.add_argument("--planner-cache", help="Trip planner segment cache", default=os.path.join(gtfsfeed.CACHE, 'segments.db'))
+  parser.add_argument("--planner-jobs", help="Concurrent trip planner requests", default=8, type=int)
   parser.add_argument("--trips", help="Include trip details", action="store_true")
+  parser.add_argument("--cache", help="Preprocessed feed cache directory", default=gtfsfeed.CACHE)
+  parser.add_argument("--nocache", help="Do not read or write the feed cache", action="store_true")
+  parser.add_argument("--jobs", help="Export routes using this many processes", default=1, type=int)
+  parser.add_argument("--previous", help="Earlier GeoJSON export; reuse features of routes that have not changed")
+  instrument.add_arguments(parser)
 
   args = parser.parse_args()
+  instrument.setup(args)
   filename = args.filename
   output = args.output
   
-  # Open the GTFS .zip or cache-y sqlite version.
-  if filename.endswith(".db"):
-    sched = pygtfs.Schedule(filename)
-  elif filename.endswith(".zip"):
-    sched = pygtfs.Schedule(":memory:")
-    pygtfs.append_feed(sched, filename)
+  # Read the GTFS .zip, or cache-y sqlite version, into columnar tables.
+  gtfs = gtfsfeed.open_feed(filename, cache=None if args.nocache else args.cache)
 
   # Get routes
-  routes = sched.routes
+  routes = gtfs.routes
   if args.route:
-    routes = [i for i in sched.routes if i.route_id in args.route]
+    routes = [i for i in gtfs.routes if i['route_id'] in args.route]
   if args.exclude:
-    routes = [i for i in sched.routes if i.route_id not in args.exclude]
+    routes = [i for i in gtfs.routes if i['route_id'] not in args.exclude]
+
+  # Plan all the uncached segments up front, concurrently.
+  if args.planner:
+    with instrument.stage('planning'):
+      plan_segments(routes, gtfs, args.planner, args.planner_cache, jobs=args.planner_jobs)
 
-  # Calculate route stats and add to collection
-  c = []
-  for route in routes:
-    for f in route_info(route, sched=sched, planner=args.planner, includetrips=args.trips):
-      c.append(f)
+  # Features of unchanged routes from an earlier export.
+  with instrument.stage('previous export'):
+    previous = previous_features(args.previous) if args.previous else None
 
-  if args.stops:
+  # Calculate route stats and stream each feature to the geojson output.
+  c = geostream.FeatureWriter(geostream.open_output(args.output), ndjson=args.ndjson) if args.output else None
+  pyramid = tiles.Pyramid(args.tiles, zooms=map(int, args.zooms.split(","))) if args.tiles else None
+  for f in export_routes(routes, gtfs, planner=args.planner, includetrips=args.trips, jobs=args.jobs, text=True, cache=args.planner_cache, previous=previous):
+    if c:
+      with instrument.stage('output write'):
+        c.write(f)
+    if pyramid:
+      with instrument.stage('tiles'):
+        pyramid.add(json.loads(f))
+
+  if args.stops and c:
     # Gather all the stops
-    stops = set()
-    for route in routes:
-      for trip in route.trips:
-        for stop in trip.stop_times:
-          stops.add(stop.stop)
-    for stop in stops:
-      c.append(stop_as_geo(stop))
-
-  # Write the geojson output.
-  if args.output:
-    with open(args.output, "w") as f:
-      geojson.dump(geojson.FeatureCollection(c), f)
-    
+    with instrument.stage('stops'):
+      for stop in gtfs.route_stops([route['route_id'] for route in routes]):
+        c.write(geojson.dumps(stop_as_geo(stop, gtfs)))
+
+  if c:
+    c.close()
+  if pyramid:
+    with instrument.stage('tiles'):
+      pyramid.write()
+  instrument.finish(args)
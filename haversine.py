@@ -1,25 +1,62 @@
-import math
+import numpy
+
+# 6371 km is the radius of the Earth
+RADIUS = 6371.0
+MILE = 1.60934
+
+def distance(lon1, lat1, lon2, lat2, miles=False):
+    """
+    Calculate the great circle distance between points
+    on the earth (specified in decimal degrees). Arguments may be
+    arrays, and are broadcast against each other.
+    """
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(numpy.radians, (lon1, lat1, lon2, lat2))
+
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = numpy.sin(dlat/2)**2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon/2)**2
+    c = 2 * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+    km = RADIUS * c
+    if miles:
+      return km / MILE
+    return km
 
 def haversine(point1, point2, miles=False): # lon1, lat1, lon2, lat2):
     """
-    Calculate the great circle distance between two points 
+    Calculate the great circle distance between two points
     on the earth (specified in decimal degrees)
     """
-    # convert decimal degrees to radians     
-    lon1, lat1 = map(math.radians, point1)
-    lon2, lat2 = map(math.radians, point2)
-
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a)) 
-
-    # 6371 km is the radius of the Earth
-    km = 6371 * c
-    if miles:
-      return km / 1.60934 
-    return km 
-    
+    return float(distance(point1[0], point1[1], point2[0], point2[1], miles=miles))
+
+def segments(coordinates, miles=False):
+    """Distance of each segment along a sequence of (lon, lat) points."""
+    c = numpy.asarray(coordinates, dtype=numpy.float64).reshape(-1, 2)
+    return distance(c[:-1,0], c[:-1,1], c[1:,0], c[1:,1], miles=miles)
+
+def cumulative(coordinates, miles=False):
+    """Distance traveled at each point of a LineString; starts at 0."""
+    return numpy.concatenate([[0.0], numpy.cumsum(segments(coordinates, miles=miles))])
+
+def matrix(points1, points2, miles=False):
+    """Pairwise distances, shape (len(points1), len(points2))."""
+    a = numpy.asarray(points1, dtype=numpy.float64).reshape(-1, 2)
+    b = numpy.asarray(points2, dtype=numpy.float64).reshape(-1, 2)
+    return distance(a[:,0,None], a[:,1,None], b[None,:,0], b[None,:,1], miles=miles)
+
+def nearest(points1, points2, miles=False, chunk=1024):
+    """For each of points1, the index of and distance to the nearest of points2."""
+    a = numpy.asarray(points1, dtype=numpy.float64).reshape(-1, 2)
+    index = numpy.zeros(len(a), dtype=numpy.int64)
+    dist = numpy.zeros(len(a), dtype=numpy.float64)
+    # Work in chunks to bound the size of the distance matrix.
+    for i in range(0, len(a), chunk):
+      m = matrix(a[i:i+chunk], points2, miles=miles)
+      index[i:i+chunk] = m.argmin(axis=1)
+      dist[i:i+chunk] = m[numpy.arange(len(m)), index[i:i+chunk]]
+    return index, dist
+
 # feature = {'type': 'LineString', 'coordinates': [[-121.88644409179688, 37.29699797218557], [-121.80198669433592, 37.298090424438506]]}
-# print haversine(feature['coordinates'][0], feature['coordinates'][1])
\ No newline at end of file
+# print haversine(feature['coordinates'][0], feature['coordinates'][1])
@@ -0,0 +1,118 @@
+"""Stage timings, counters and peak memory, shared by the command line tools.
+
+  with instrument.stage('feed load'):
+    ...
+  instrument.count('http requests')
+  instrument.log("Detail only printed with --verbose")
+
+Each tool takes --profile, to print a summary table when it finishes and
+write the same numbers as JSON, and --verbose, for per-trip and
+per-request detail.
+"""
+import collections
+import contextlib
+import json
+import resource
+import sys
+import threading
+import time
+
+# Print per-trip and per-request detail.
+verbose = False
+
+def peak_rss(who=resource.RUSAGE_SELF):
+  """Peak resident set size, in KB."""
+  rss = resource.getrusage(who).ru_maxrss
+  # Linux reports KB, OS X bytes.
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+class Profiler(object):
+  """Wall time per stage, event counters, and peak RSS.
+
+  Stages run in several threads add up, so a stage may take longer than
+  the whole run.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.started = time.time()
+    self.stages = collections.OrderedDict()
+    self.counters = collections.OrderedDict()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    t = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, time.time() - t)
+
+  def add(self, name, seconds, calls=1):
+    with self.lock:
+      s = self.stages.setdefault(name, [0.0, 0])
+      s[0] += seconds
+      s[1] += calls
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def stats(self):
+    return collections.OrderedDict([
+      ('wall', time.time() - self.started),
+      ('peak_rss_kb', peak_rss()),
+      ('children_peak_rss_kb', peak_rss(resource.RUSAGE_CHILDREN)),
+      ('stages', collections.OrderedDict((k, {'seconds': v[0], 'calls': v[1]}) for k, v in self.stages.items())),
+      ('counters', self.counters.copy())
+    ])
+
+  def merge(self, stats):
+    """Add the stages and counters of stats from another process."""
+    for k, v in stats['stages'].items():
+      self.add(k, v['seconds'], calls=v['calls'])
+    for k, v in stats['counters'].items():
+      self.count(k, v)
+
+  def report(self, filename=None, f=sys.stderr):
+    """Print a summary table; write the stats as JSON to filename."""
+    stats = self.stats()
+    print >> f, "===== Profile ====="
+    print >> f, "%-24s %10s %8s %6s"%("stage", "seconds", "calls", "%")
+    for k, v in stats['stages'].items():
+      print >> f, "%-24s %10.3f %8d %6.1f"%(k, v['seconds'], v['calls'], 100.0 * v['seconds'] / max(stats['wall'], 1e-9))
+    for k, v in stats['counters'].items():
+      print >> f, "%-24s %19d"%(k, v)
+    print >> f, "%-24s %10.3f"%("wall", stats['wall'])
+    print >> f, "%-24s %10d KB"%("peak rss", max(stats['peak_rss_kb'], stats['children_peak_rss_kb']))
+    if filename:
+      with open(filename, 'w') as out:
+        json.dump(stats, out, indent=2)
+
+profiler = Profiler()
+stage = profiler.stage
+count = profiler.count
+
+def log(*args):
+  """Print only with --verbose."""
+  if verbose:
+    print " ".join(map(str, args))
+
+def count_queries(engine):
+  """Count the queries a SQLAlchemy engine runs."""
+  from sqlalchemy import event
+  event.listen(engine, 'before_cursor_execute', lambda *args:count('db queries'))
+
+def add_arguments(parser):
+  parser.add_argument("--profile", help="Print time per stage, counters and peak memory when done; and write them as JSON to this file", nargs="?", const="profile.json")
+  parser.add_argument("--verbose", help="Print per-trip and per-request detail", action="store_true")
+
+def setup(args):
+  global verbose
+  verbose = args.verbose
+  profiler.reset()
+
+def finish(args):
+  if args.profile:
+    profiler.report(args.profile)
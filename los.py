@@ -0,0 +1,60 @@
+"""Level of Service index for route groups.
+
+Departure counts are bucketed by time of day into a cumulative array,
+so the number of departures in any bucket-aligned window is the
+difference of two entries, and the front end never needs per-trip data.
+"""
+import numpy
+
+# Level of Service definitions: (name, min headway, max headway) in seconds.
+# Keep in sync with LOS in map.backbone.js and map.js
+LOS = [
+  (' ', 7200, float('inf')),
+  ('F', 3600, 7200),
+  ('E', 1800, 3600),
+  ('D', 1200, 1800),
+  ('C', 900, 1200),
+  ('B', 600, 900),
+  ('A', -1, 600)
+]
+
+# Bucket size, and the service day covered (GTFS times may pass midnight).
+BUCKET = 900
+SPAN = 30 * 3600
+
+# Standard windows, in seconds since midnight.
+WINDOWS = [
+  ('early', 5 * 3600, 7 * 3600),
+  ('am', 7 * 3600, 9 * 3600),
+  ('midday', 9 * 3600, 15 * 3600),
+  ('pm', 15 * 3600, 19 * 3600),
+  ('evening', 19 * 3600, 22 * 3600),
+  ('night', 22 * 3600, 29 * 3600)
+]
+
+def trip_counts(starts, bucket=BUCKET, span=SPAN):
+  """Cumulative departures: entry k is the number of starts <= k * bucket."""
+  edges = numpy.arange(0, span + bucket, bucket)
+  return numpy.searchsorted(numpy.sort(numpy.asarray(starts)), edges, side='right')
+
+def count(counts, start, end, bucket=BUCKET):
+  """Departures in (start, end], for bucket-aligned start and end."""
+  at = lambda t:counts[max(0, min(len(counts) - 1, int(t // bucket)))]
+  return int(at(end) - at(start))
+
+def los(trips, start, end):
+  """Level of Service name for trips departures in (start, end]."""
+  headway = float(end - start) / trips if trips else float('inf')
+  for name, lo, hi in LOS:
+    if lo < headway <= hi:
+      return name
+  return LOS[-1][0]
+
+def index(starts, bucket=BUCKET, span=SPAN):
+  """Properties for a route group: cumulative counts and standard window LOS."""
+  counts = trip_counts(starts, bucket=bucket, span=span)
+  return {
+    'trip_counts_bucket': bucket,
+    'trip_counts': counts.tolist(),
+    'los': dict((name, los(count(counts, start, end, bucket=bucket), start, end)) for name, start, end in WINDOWS)
+  }
@@ -1,23 +1,116 @@
 import argparse
+import httplib
 import json
+import multiprocessing.pool
+import socket
+import sys
+import threading
+import time
 import urllib
-import urllib2
+import urlparse
 import geojson
 import os
+
+import instrument
+
 def fjoin(a):
   return ",".join(map(str, a))
 
+class Client(object):
+  """OTP client: one keep-alive connection per thread, with retries."""
+  def __init__(self, endpoint, retries=3, backoff=2.0, timeout=600):
+    url = urlparse.urlparse(endpoint)
+    self.connection_class = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+    self.netloc = url.netloc
+    self.prefix = url.path.rstrip('/')
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.local = threading.local()
+
+  def connection(self):
+    if getattr(self.local, 'conn', None) is None:
+      self.local.conn = self.connection_class(self.netloc, timeout=self.timeout)
+    return self.local.conn
+
+  def request(self, verb, method, **kwargs):
+    params = urllib.urlencode(kwargs, doseq=True)
+    path = '%s/%s?%s'%(self.prefix, method, params)
+    instrument.log('%s %s%s'%(verb, self.netloc, path))
+    for attempt in range(self.retries + 1):
+      try:
+        instrument.count('http requests')
+        with instrument.stage('http'):
+          conn = self.connection()
+          conn.request(verb, path, '' if verb == 'POST' else None)
+          response = conn.getresponse()
+          body = response.read()
+        if response.status >= 500:
+          raise IOError("%s %s: HTTP %s"%(verb, path, response.status))
+        if response.status >= 400:
+          raise ValueError("%s %s: HTTP %s"%(verb, path, response.status))
+        return json.loads(body)
+      except (httplib.HTTPException, socket.error, IOError), e:
+        # Drop the connection; it will be reopened on the next try.
+        if self.local.conn is not None:
+          self.local.conn.close()
+        self.local.conn = None
+        if attempt == self.retries:
+          raise
+        wait = self.backoff * 2 ** attempt
+        instrument.count('http retries')
+        print "Retrying in %ss: %s"%(wait, e)
+        time.sleep(wait)
+
+_clients = {}
+
+def client(endpoint):
+  if endpoint not in _clients:
+    _clients[endpoint] = Client(endpoint)
+  return _clients[endpoint]
+
 def getjson(endpoint, method, **kwargs):
-  params = urllib.urlencode(kwargs, doseq=True)
-  print '%s/%s?%s'%(endpoint, method, params)
-  response = urllib2.urlopen('%s/%s?%s'%(endpoint, method, params)).read()
-  return json.loads(response)
+  return client(endpoint).request('GET', method, **kwargs)
 
 def postjson(endpoint, method, **kwargs):
-  params = urllib.urlencode(kwargs, doseq=True)
-  print '%s/%s?%s'%(endpoint, method, params)
-  response = urllib2.urlopen('%s/%s?%s'%(endpoint, method, params), '').read()
-  return json.loads(response)
+  return client(endpoint).request('POST', method, **kwargs)
+
+def outputs(args, stop):
+  """Isochrone and indicator output filenames for a stop."""
+  return (
+    os.path.join(args.outdir, '%s.%s.isochrones.geojson'%(args.scenario, stop['stop_id'])),
+    os.path.join(args.outdir, '%s.%s.indicators.json'%(args.scenario, stop['stop_id']))
+  )
+
+def dump(data, filename):
+  # Write then rename, so an interrupted run never leaves a partial output.
+  with open(filename + '.tmp', 'wb') as f:
+    json.dump(data, f)
+  os.rename(filename + '.tmp', filename)
+
+def isochrone(args, stop):
+  print "======= Creating isochrone for stop:", stop['stop_id']
+  instrument.log("Trying with banned:", args.banned)
+  kw = {}
+  if args.banned:
+    kw['bannedAgencies'] = ",".join(args.banned)
+    
+  surface = postjson(args.host,
+    "otp/surfaces",
+    fromPlace=fjoin([stop['stop_lat'], stop['stop_lon']]),
+    clampInitialWait=3600,
+    cutoffMinutes=args.cutoff,
+    date=args.date,
+    time=args.time,
+    batch=True, **kw)
+  instrument.log("Surface:", surface['id'])
+
+  isochrones_file, indicators_file = outputs(args, stop)
+  isochrone = getjson(args.host, "otp/surfaces/%s/isochrone"%surface['id'], spacing=args.spacing)
+  indicators = getjson(args.host, 'otp/surfaces/%s/indicator'%surface['id'], targets='census.geo')
+  with instrument.stage('output write'):
+    dump(isochrone, isochrones_file)
+    dump(indicators, indicators_file)
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
@@ -31,7 +124,11 @@ if __name__ == "__main__":
   parser.add_argument("--scenario", help="Scenario name", default="test")
   parser.add_argument("--stop_data", help="Stop data")
   parser.add_argument("--stop_ids", help="Stop IDs", action="append")
+  parser.add_argument("--jobs", help="Stops to process concurrently", default=4, type=int)
+  parser.add_argument("--force", help="Recreate existing outputs", action="store_true")
+  instrument.add_arguments(parser)
   args = parser.parse_args()
+  instrument.setup(args)
 
   with open(args.stop_data) as f:
     data = json.load(f)
@@ -39,34 +136,34 @@ if __name__ == "__main__":
   # stops = filter(lambda x:x['geometry']['type'] == 'Point', data['features'])
 
   stop_ids = [i['stop_id'] for i in stops]
-  print "Known stop_ids:", ", ".join(stop_ids)
+  instrument.log("Known stop_ids:", ", ".join(stop_ids))
   args.stop_ids = args.stop_ids or stop_ids
   print "Using stop_ids:", ", ".join(args.stop_ids)
 
   args.banned = args.banned or []
   
-  stops = [stop for stop in stops if stop['stop_id'] in args.stop_ids]
-  for stop in stops:
-    print "======= Creating isochrone for stop:", stop
-    print "Trying with banned:", args.banned
-    kw = {}
-    if args.banned:
-      kw['bannedAgencies'] = ",".join(args.banned)
-      
-    surface = postjson(args.host,
-      "otp/surfaces",
-      fromPlace=fjoin([stop['stop_lat'], stop['stop_lon']]),
-      clampInitialWait=3600,
-      cutoffMinutes=args.cutoff,
-      date=args.date,
-      time=args.time,
-      batch=True, **kw)
-    print "Surface:", surface['id']
-
-    isochrone = getjson(args.host, "otp/surfaces/%s/isochrone"%surface['id'], spacing=args.spacing)
-    with open(os.path.join(args.outdir, '%s.%s.isochrones.geojson'%(args.scenario, stop['stop_id'])), 'wb') as f:
-      json.dump(isochrone, f)
-    
-    indicators = getjson(args.host, 'otp/surfaces/%s/indicator'%surface['id'], targets='census.geo')
-    with open(os.path.join(args.outdir, '%s.%s.indicators.json'%(args.scenario, stop['stop_id'])), 'wb') as f:
-      json.dump(indicators, f)
+  wanted = set(args.stop_ids)
+  stops = [stop for stop in stops if stop['stop_id'] in wanted]
+  if not args.force:
+    # Resume: skip stops that already have all their outputs.
+    done = set(stop['stop_id'] for stop in stops if all(map(os.path.exists, outputs(args, stop))))
+    print "Skipping %s stops with existing outputs"%len(done)
+    stops = [stop for stop in stops if stop['stop_id'] not in done]
+
+  def run(stop):
+    try:
+      isochrone(args, stop)
+    except Exception, e:
+      print "Failed stop %s: %s"%(stop['stop_id'], e)
+      return stop
+  
+  pool = multiprocessing.pool.ThreadPool(args.jobs)
+  failed = filter(None, pool.imap_unordered(run, stops))
+  pool.close()
+  pool.join()
+  instrument.count('stops', len(stops))
+  instrument.count('failed stops', len(failed))
+  instrument.finish(args)
+  if failed:
+    print "Failed stops:", ", ".join(stop['stop_id'] for stop in failed)
+    sys.exit(1)
@@ -20,7 +20,7 @@ var colors = [
 ].reverse()
 
 
-// Level of Service definitions.
+// Level of Service definitions; keep in sync with los.py
 var LOS = [{
   name: ' ',
   label: 'No service',
@@ -84,6 +84,21 @@ function seconds_to_clock(t) {
   return pad(h,2)+':'+pad(m,2)
 }
 
+function count_trips(counts, bucket, start, end) {
+  // Departures in (start, end], from the precomputed cumulative counts.
+  function at(t){return counts[Math.max(0, Math.min(counts.length-1, Math.floor(t/bucket)))]}
+  return at(end) - at(start)
+}
+
+function tile_xy(latlng, z) {
+  // Slippy map tile containing a point; see tiles.py
+  var n = Math.pow(2, z);
+  var lat = Math.max(-85.0511, Math.min(85.0511, latlng.lat)) * Math.PI / 180;
+  var x = Math.floor((latlng.lng + 180) / 360 * n);
+  var y = Math.floor((1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2 * n);
+  return [Math.max(0, Math.min(n-1, x)), Math.max(0, Math.min(n-1, y))]
+}
+
 function get_qs(name) {
   name = name.replace(/[\[]/, "\\[").replace(/[\]]/, "\\]");
   var regex = new RegExp("[\\?&]" + name + "=([^&#]*)"),
@@ -98,7 +113,7 @@ var Trip = Backbone.Model.extend({
   // This is somewhat inverted from GTFS to simplify the GeoJSON.
   defaults: {
     los: 0,
-    los_trips: [],
+    los_trips: 0,
     display: true,
     color: '#ccc'
   },
@@ -115,15 +130,19 @@ var Trip = Backbone.Model.extend({
     this.set('color', color);
   },
   calc_trips: function(start, end) {
-    // Calculate Level of Service.
-    var starts = this.get('properties').trip_starts.filter(function(i) {
+    // Number of departures in the window.
+    var properties = this.get('properties');
+    if (properties.trip_counts) {
+      return count_trips(properties.trip_counts, properties.trip_counts_bucket, start, end);
+    }
+    var starts = properties.trip_starts.filter(function(i) {
       return i > start && i <= end
     });
-    return starts
+    return starts.length
   },
-  calc_los: function(start, end, starts) {
+  calc_los: function(start, end, trips) {
     // Buses per hour
-    var headway = ((end-start)/3600 / starts.length) * 3600;
+    var headway = ((end-start)/3600 / trips) * 3600;
     // Find the LOS.
     for (var i in LOS) {
       if (headway > LOS[i].min && headway <= LOS[i].max) {
@@ -193,11 +212,12 @@ var TripView = Backbone.View.extend({
       .css('background-color', this.model.get('color'));
   },
   check_schedule: function() {
-    var schedule = this.model.get('properties').route_schedule;
-    var starts = schedule.map(function(i){return i[0]});
-    var ends = schedule.map(function(i){return i[i.length-1]});
+    // route_schedule is each trip's time offsets from its trip_starts entry.
+    var properties = this.model.get('properties');
+    var starts = properties.trip_starts;
+    var ends = (properties.route_schedule || []).map(function(i, j){return starts[j] + i[i.length-1]});
     var start = Math.min.apply(null, starts);
-    var end = Math.min.apply(null, ends);
+    var end = Math.max.apply(null, ends.length ? ends : starts);
     this.$('.transvisor-trip-hours').text(
       seconds_to_clock(start) + " - " + seconds_to_clock(end)
     )
@@ -215,11 +235,39 @@ var TripMapView = Backbone.View.extend({
     this.listenTo(this.model, 'change:color', this.set_color);
   },
   render: function() {
-    this.layer = L.geoJson(this.model.attributes, {
+    // Base geometry, plus more detailed geometry for each tile zoom level.
+    this.base = L.geoJson(this.model.attributes, {
       style: this.model.get_style()
     });
+    this.details = {};
+    this.zoom = null;
+    this.layer = L.featureGroup([this.base]);
     return this.layer
   },
+  add_detail: function(z, feature) {
+    // Add a piece of this Trip's geometry from a tile.
+    if (!this.details[z]) {
+      this.details[z] = L.geoJson(null, {style: this.model.get_style()});
+    }
+    this.details[z].addData(feature);
+    if (z == this.zoom) {
+      this.set_zoom(z);
+    }
+  },
+  set_zoom: function(z) {
+    // Show the most detailed geometry loaded for this zoom level.
+    this.zoom = z;
+    var show = this.details[z] || this.base;
+    var layers = [this.base].concat(_.values(this.details));
+    for (var i in layers) {
+      if (layers[i] == show) {
+        this.layer.addLayer(layers[i]);
+      } else {
+        this.layer.removeLayer(layers[i]);
+      }
+    }
+    this.model.get('display') ? this.show() : this.hide();
+  },
   set_display: function(e) {
     this.model.get('display') ? this.show() : this.hide();
   },
@@ -330,9 +378,16 @@ var TransvisorApp = Backbone.View.extend({
     this.routeviews = [];
     // MapViews
     this.mapviews = [];
+    // MapViews by group_id, for adding tile geometry.
+    this.mapview_index = {};
     // AgencyCollection.
     this.collection = new AgencyCollection();
     this.collection.url = options.url;
+    // Tile pyramid: route properties are in routes.json, detailed geometry in tiles.
+    this.tiles = options.tiles;
+    if (this.tiles) {
+      this.collection.url = this.tiles + '/routes.json';
+    }
     // The Leaflet map, and layer group.
     this.leaflet = options.leaflet;
     this.layer = new L.LayerGroup().addTo(this.leaflet); 
@@ -343,6 +398,58 @@ var TransvisorApp = Backbone.View.extend({
     this.listenTo(this.collection, 'sync', this.fit_all);
     // Load the data.
     this.collection.fetch();
+    if (this.tiles) {
+      this.leaflet.on('moveend', this.load_tiles, this);
+      this.listenTo(this.collection, 'sync', this.load_index);
+    }
+  },
+  load_index: function() {
+    // Load the list of available tiles.
+    var self = this;
+    $.getJSON(this.tiles + '/index.json', function(index) {
+      self.index = index;
+      self.available = {};
+      _.each(index.tiles, function(tiles, z) {
+        _.each(tiles, function(i){self.available[z + '/' + i] = true});
+      });
+      self.loaded = {};
+      self.load_tiles();
+    });
+  },
+  load_tiles: function() {
+    // Load the tiles in view, at the closest pyramid zoom level.
+    if (!this.index) {return}
+    var self = this;
+    var zoom = this.leaflet.getZoom();
+    var z = _.filter(this.index.zooms, function(i){return i <= zoom}).pop();
+    if (z == null) {
+      z = this.index.zooms[0];
+    }
+    // The lowest zoom level is the base geometry in routes.json.
+    if (z != this.index.zooms[0]) {
+      var bounds = this.leaflet.getBounds();
+      var nw = tile_xy(bounds.getNorthWest(), z);
+      var se = tile_xy(bounds.getSouthEast(), z);
+      for (var x = nw[0]; x <= se[0]; x++) {
+        for (var y = nw[1]; y <= se[1]; y++) {
+          var key = z + '/' + x + '/' + y;
+          if (this.available[key] && !this.loaded[key]) {
+            this.loaded[key] = true;
+            $.getJSON(this.tiles + '/' + key + '.json', _.bind(this.add_tile, this, z));
+          }
+        }
+      }
+    }
+    _.each(this.mapviews, function(view){view.set_zoom(z)});
+  },
+  add_tile: function(z, data) {
+    // Add tile geometry to the matching Trips.
+    for (var i in data.features) {
+      var view = this.mapview_index[data.features[i].properties.group_id];
+      if (view) {
+        view.add_detail(z, data.features[i]);
+      }
+    }
   },
   add_to_route: function(trip) {
     // Calculate LOS...
@@ -382,6 +489,7 @@ var TransvisorApp = Backbone.View.extend({
     // And also add a second View for the map layer.
     var view = new TripMapView({model: trip});
     this.mapviews.push(view);
+    this.mapview_index[trip.get('properties').group_id] = view;
     this.layer.addLayer(view.render());
   },
   hide_all: function() {
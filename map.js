@@ -14,7 +14,7 @@ function get_qs(name) {
 
 // Colors: colorbrewer2.org
 var colors = ['#d73027', '#fc8d59', '#fee090', '#e0f3f8', '#91bfdb', '#4575b4'].reverse();
-// Level of Service definitions.
+// Level of Service definitions; keep in sync with los.py
 var LOS = [
   {name: ' ', label: 'None', min:7200, max:Infinity, color:'#ccc', opacity: 1.0, width: 1.0},
   {name: 'F', label: '>60m', min:3600, max:7200,     color:colors[5], opacity: 1.0, width: 1.0},
@@ -67,11 +67,20 @@ gtfsControl.prototype.calc_los = function(feature, start, end) {
   // Start and end are in seconds since midnight.
   var start = start || 7 * 3600;
   var end = end || 9 * 3600;
-  var starts = feature.properties.trip_starts.filter(function(i) {
-    return i > start && i <= end
-  });
+  var trips = 0;
+  if (feature.properties.trip_counts) {
+    // Precomputed cumulative departures, so any window is a difference.
+    var counts = feature.properties.trip_counts;
+    var bucket = feature.properties.trip_counts_bucket;
+    var at = function(t){return counts[Math.max(0, Math.min(counts.length-1, Math.floor(t/bucket)))]};
+    trips = at(end) - at(start);
+  } else {
+    trips = feature.properties.trip_starts.filter(function(i) {
+      return i > start && i <= end
+    }).length;
+  }
   // Buses per hour
-  var headway = ((end-start)/3600 / starts.length) * 3600;
+  var headway = ((end-start)/3600 / trips) * 3600;
   // Find the LOS.
   for (var i in LOS) {
     if (headway > LOS[i].min && headway <= LOS[i].max) {
@@ -132,7 +141,7 @@ gtfsControl.prototype.show_routecontrol = function(route) {
   var elem = $(this);
   var dialog = $('<div />').attr('title', 'Trips');
   var ul = $('<ul />').appendTo(dialog);
-  for (var t in route.properties.trip_starts) {
+  for (var t in route.properties.trip_starts || []) {
     $('<li />').text(seconds_to_clock(route.properties.trip_starts[t])).appendTo(ul);
   }
   dialog.dialog({
@@ -1,29 +1,152 @@
+"""Route statistics: one route in detail, or every route in the feed."""
 import numpy
+import argparse
 import collections
-import pygtfs
+import csv
+import datetime
+import json
 import sys
 
-stops = collections.defaultdict(int)
-
-sched = pygtfs.Schedule(sys.argv[1])
-for r in sched.routes_by_id(sys.argv[2]):
-  durations = []
-  trips = r.trips
-  for trip in trips:
-    trip.stop_times = sorted(trip.stop_times, key=lambda x:x.stop_sequence)
-
-  trips = sorted(trips, key=lambda x:x.stop_times[0].arrival_time)
-  for trip in trips:
-    start = trip.stop_times[0].arrival_time
-    end = trip.stop_times[-1].arrival_time
-    duration = (end - start).seconds
-    durations.append(duration)
-    key = tuple(i.stop_id for i in trip.stop_times)
-    stops[key] += 1
-    print "Start:", start, "End:", end, "Duration:", duration
-
-  print "Median duration:", numpy.median(durations)
-    
-for k,v in sorted(stops.items(), key=lambda x:x[1]):
-  print "=== %s stops, %s trip ==="%(len(k), v)
-  print k
+import feed as gtfsfeed
+import haversine
+import instrument
+
+# Trip duration percentiles.
+PERCENTILES = [10, 50, 90]
+
+def route_detail(sched, route_id):
+  """Print each trip of a route, and its stop patterns."""
+  stops = collections.defaultdict(int)
+  for r in [i for i in sched.routes if i['route_id'] == route_id]:
+    durations = []
+    trips = [i for i in sched.route_trips.get(r['route_id'], []) if sched.trip_offsets[i+1] > sched.trip_offsets[i]]
+
+    trips = sorted(trips, key=lambda x:sched.st_arrival[sched.trip_offsets[x]])
+    for trip in trips:
+      s = sched.stop_times(trip)
+      start = sched.st_arrival[s][0]
+      end = sched.st_arrival[s][-1]
+      duration = end - start
+      durations.append(duration)
+      key = tuple(sched.stop_id[sched.st_stop[s]])
+      stops[key] += 1
+      print "Start:", datetime.timedelta(seconds=int(start)), "End:", datetime.timedelta(seconds=int(end)), "Duration:", duration
+
+    print "Median duration:", numpy.median(durations)
+
+  for k,v in sorted(stops.items(), key=lambda x:x[1]):
+    print "=== %s stops, %s trip ==="%(len(k), v)
+    print k
+
+def segment_speeds(sched):
+  """Speed in km/h of each stop_times segment, and its trip; NaN if unknown."""
+  lon, lat = sched.stop_lon[sched.st_stop], sched.stop_lat[sched.st_stop]
+  km = haversine.distance(lon[:-1], lat[:-1], lon[1:], lat[1:])
+  dt = (sched.st_arrival[1:] - sched.st_arrival[:-1]).astype(numpy.float64)
+  valid = (sched.st_trip[1:] == sched.st_trip[:-1]) & (sched.st_arrival[1:] >= 0) & (sched.st_arrival[:-1] >= 0)
+  speed = numpy.where(valid & (dt > 0), km / numpy.maximum(dt, 1) * 3600, numpy.nan)
+  return speed, sched.st_trip[1:], km * valid
+
+def all_routes(sched):
+  """Statistics for every route's Monday service, from one pass over the stop_times columns."""
+  # One service day, as in gtfs_geojson.py; weekend service is not added in.
+  monday = numpy.in1d(sched.trip_service, list(sched.services))
+  starts, ends = sched.trip_starts(), sched.trip_ends()
+  durations = ends - starts
+  patterns, _ = sched.trip_patterns()
+  speed, speed_trip, km = segment_speeds(sched)
+  speed = numpy.where(monday[speed_trip], speed, numpy.nan)
+  # Average speed of each trip.
+  trip_km = numpy.bincount(speed_trip, weights=km, minlength=len(sched.trip_id))
+  trip_speed = numpy.where(durations > 0, trip_km / numpy.maximum(durations, 1) * 3600, numpy.nan)
+  # Segments grouped by route.
+  segment_order = numpy.argsort(sched.trip_route[speed_trip], kind='mergesort')
+  segment_routes = sched.trip_route[speed_trip][segment_order]
+
+  results = []
+  for route in sched.routes:
+    trips = sched.route_trips.get(route['route_id'], numpy.zeros(0, dtype=int))
+    trips = trips[monday[trips] & (starts[trips] >= 0) & (ends[trips] >= 0)]
+    r = collections.OrderedDict()
+    for k in ['route_id', 'route_short_name', 'route_long_name']:
+      r[k] = route[k]
+    r['trips'] = len(trips)
+    r['patterns'] = len(numpy.unique(patterns[trips]))
+    if not len(trips):
+      results.append(r)
+      continue
+    # Span of service.
+    r['first_departure'] = int(starts[trips].min())
+    r['last_arrival'] = int(ends[trips].max())
+    r['span_hours'] = round((r['last_arrival'] - r['first_departure']) / 3600.0, 2)
+    # Trip durations, in minutes.
+    d = durations[trips] / 60.0
+    r['duration_min'] = round(d.min(), 1)
+    for p, v in zip(PERCENTILES, numpy.percentile(d, PERCENTILES)):
+      r['duration_p%s'%p] = round(v, 1)
+    r['duration_max'] = round(d.max(), 1)
+    # Speeds, in km/h.
+    s = trip_speed[trips]
+    s = s[numpy.isfinite(s)]
+    r['trip_speed_median'] = round(numpy.median(s), 1) if len(s) else None
+    a, b = numpy.searchsorted(segment_routes, route['route_id'], side='left'), numpy.searchsorted(segment_routes, route['route_id'], side='right')
+    s = speed[segment_order[a:b]]
+    s = s[numpy.isfinite(s)]
+    for p, v in zip(PERCENTILES, numpy.percentile(s, PERCENTILES) if len(s) else [None] * len(PERCENTILES)):
+      r['segment_speed_p%s'%p] = None if v is None else round(v, 1)
+    # Stop pattern variants: trips on each pattern, most common first.
+    r['pattern_trips'] = sorted(numpy.bincount(patterns[trips]).tolist(), reverse=True)
+    r['pattern_trips'] = [i for i in r['pattern_trips'] if i]
+    # Departures per hour in each direction, and the resulting headway in
+    # minutes; headways is the worst direction running in each hour.
+    directions = sched.trip_direction[trips]
+    r['headways_by_direction'] = collections.OrderedDict()
+    for d in numpy.unique(directions).tolist():
+      hours = numpy.bincount(starts[trips[directions == d]] // 3600 % 24, minlength=24)
+      r['headways_by_direction']['none' if d < 0 else str(d)] = collections.OrderedDict(('%02d'%h, round(60.0 / n, 1)) for h, n in enumerate(hours.tolist()) if n)
+    r['headways'] = collections.OrderedDict()
+    for h in ['%02d'%h for h in range(24)]:
+      worst = [v[h] for v in r['headways_by_direction'].values() if h in v]
+      if worst:
+        r['headways'][h] = max(worst)
+    results.append(r)
+  return results
+
+def write_csv(results, f):
+  """One row per route; per-hour headways, of the worst direction, in headway_HH columns."""
+  hours = ['headway_%02d'%h for h in range(24)]
+  fields = []
+  for r in results:
+    fields += [k for k in r if k not in fields and k not in ('headways', 'headways_by_direction', 'pattern_trips')]
+  writer = csv.writer(f)
+  writer.writerow(fields + ['pattern_trips'] + hours)
+  for r in results:
+    headways = r.get('headways', {})
+    writer.writerow([r.get(k, '') for k in fields] + [" ".join(map(str, r.get('pattern_trips', [])))] + [headways.get(h[-2:], '') for h in hours])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("filename", help="GTFS .zip file, or cached sqlite DB; shares the preprocessed cache with gtfs_geojson.py")
+  parser.add_argument("route", help="Print each trip of this route", nargs="?")
+  parser.add_argument("--output", help="Statistics for all routes: .csv or .json file, or - for CSV on stdout")
+  instrument.add_arguments(parser)
+  args = parser.parse_args()
+  instrument.setup(args)
+
+  sched = gtfsfeed.open_feed(args.filename)
+  if args.route:
+    route_detail(sched, args.route)
+
+  if args.output:
+    with instrument.stage('statistics'):
+      results = all_routes(sched)
+    with instrument.stage('output write'):
+      if args.output == '-':
+        write_csv(results, sys.stdout)
+      elif args.output.endswith('.json'):
+        with open(args.output, 'w') as f:
+          json.dump(results, f, indent=2)
+      else:
+        with open(args.output, 'wb') as f:
+          write_csv(results, f)
+  instrument.finish(args)
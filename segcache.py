@@ -0,0 +1,58 @@
+"""Persistent cache of trip planner route segments."""
+import json
+import os
+import sqlite3
+import time
+
+# Keep at most this many segments; least recently used are evicted first.
+MAXSIZE = 250000
+
+_open = {}
+
+def key(point):
+  return "%.6f,%.6f"%tuple(point)
+
+class SegmentCache(object):
+  """Planned segments, keyed by (planner, from, to), in a SQLite file."""
+  def __init__(self, path, maxsize=MAXSIZE):
+    self.path = path
+    self.maxsize = maxsize
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+      os.makedirs(parent)
+    self.db = sqlite3.connect(path, timeout=60)
+    self.db.execute("CREATE TABLE IF NOT EXISTS segments (planner TEXT, start TEXT, end TEXT, points TEXT, accessed REAL, PRIMARY KEY (planner, start, end))")
+    self.db.execute("CREATE INDEX IF NOT EXISTS segments_accessed ON segments (accessed)")
+    self.db.commit()
+    # Access times of segments read since the last commit; reads alone
+    # never take the database write lock.
+    self.accessed = {}
+
+  def get(self, planner, start, end):
+    """The cached points for a segment, or None."""
+    k = (planner, key(start), key(end))
+    row = self.db.execute("SELECT points FROM segments WHERE planner=? AND start=? AND end=?", k).fetchone()
+    if row is None:
+      return None
+    self.accessed[k] = time.time()
+    return json.loads(row[0])
+
+  def put(self, planner, start, end, points):
+    self.db.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)", (planner, key(start), key(end), json.dumps(points), time.time()))
+
+  def commit(self):
+    """Write pending changes, evicting the least recently used segments."""
+    if self.accessed:
+      self.db.executemany("UPDATE segments SET accessed=? WHERE planner=? AND start=? AND end=?", [(t,)+k for k, t in self.accessed.items()])
+      self.accessed = {}
+    count = self.db.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+    if count > self.maxsize:
+      self.db.execute("DELETE FROM segments WHERE rowid IN (SELECT rowid FROM segments ORDER BY accessed LIMIT ?)", (count - self.maxsize,))
+    self.db.commit()
+
+def open_cache(path):
+  """A SegmentCache for path, opened once per process."""
+  k = (os.getpid(), path)
+  if k not in _open:
+    _open[k] = SegmentCache(path)
+  return _open[k]
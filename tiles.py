@@ -0,0 +1,140 @@
+"""Simplified, multi-resolution tiles of route geometry.
+
+Each route group is simplified (Douglas-Peucker) to about half a pixel
+at each zoom level of the pyramid, and its coordinates are rounded to
+match. The lowest zoom is written with all the route properties to
+routes.json; higher zooms are cut into <zoom>/<x>/<y>.json tiles that
+the map loads for the current viewport.
+"""
+import collections
+import json
+import math
+import os
+import numpy
+
+ZOOMS = [8, 11, 14]
+
+def pixel(zoom):
+  """Width of a 256px tile pixel at zoom, in degrees of longitude."""
+  return 360.0 / (256 * 2 ** zoom)
+
+def simplify(points, tolerance):
+  """Douglas-Peucker simplification; returns the kept points."""
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+  if len(points) < 3:
+    return points
+  keep = numpy.zeros(len(points), dtype=bool)
+  keep[0] = keep[-1] = True
+  stack = [(0, len(points) - 1)]
+  while stack:
+    first, last = stack.pop()
+    if last - first < 2:
+      continue
+    a, b = points[first], points[last]
+    inner = points[first+1:last]
+    d = b - a
+    length = math.hypot(*d)
+    if length == 0:
+      dist = numpy.hypot(*(inner - a).T)
+    else:
+      dist = numpy.abs(d[0] * (inner[:,1] - a[1]) - d[1] * (inner[:,0] - a[0])) / length
+    i = dist.argmax()
+    if dist[i] > tolerance:
+      i += first + 1
+      keep[i] = True
+      stack.append((first, i))
+      stack.append((i, last))
+  return points[keep]
+
+def quantize(points, zoom):
+  """Round coordinates to about a tenth of a pixel, dropping repeated points."""
+  digits = max(0, int(math.ceil(-math.log10(pixel(zoom) / 10))))
+  q = numpy.round(points, digits)
+  if len(q) > 1:
+    q = q[numpy.concatenate([[True], numpy.any(q[1:] != q[:-1], axis=1)])]
+  return q
+
+def position(lon, lat, zoom):
+  """Fractional slippy map tile coordinates of each point; arguments may be arrays."""
+  n = 2 ** zoom
+  lat = numpy.radians(numpy.clip(lat, -85.0511, 85.0511))
+  x = (numpy.asarray(lon) + 180.0) / 360.0 * n
+  y = (1.0 - numpy.log(numpy.tan(lat) + 1 / numpy.cos(lat)) / math.pi) / 2.0 * n
+  # Keep points on the far edge inside the last tile.
+  edge = n - 1e-9
+  return numpy.clip(x, 0, edge), numpy.clip(y, 0, edge)
+
+def tile(lon, lat, zoom):
+  """Slippy map tile (x, y) containing each point; arguments may be arrays."""
+  x, y = position(lon, lat, zoom)
+  return numpy.floor(x).astype(int), numpy.floor(y).astype(int)
+
+def crossed(x0, y0, x1, y1):
+  """Tiles a segment passes through, in order, from fractional tile coordinates."""
+  tx, ty = int(math.floor(x0)), int(math.floor(y0))
+  ex, ey = int(math.floor(x1)), int(math.floor(y1))
+  dx, dy = x1 - x0, y1 - y0
+  sx, sy = (1 if dx > 0 else -1), (1 if dy > 0 else -1)
+  # Distance along the segment, as a fraction, to the next tile edge in x
+  # and in y, and between tile edges.
+  nx = ((tx + (sx > 0)) - x0) / dx if dx else float('inf')
+  ny = ((ty + (sy > 0)) - y0) / dy if dy else float('inf')
+  stepx = abs(1.0 / dx) if dx else float('inf')
+  stepy = abs(1.0 / dy) if dy else float('inf')
+  tiles = [(tx, ty)]
+  for i in range(abs(ex - tx) + abs(ey - ty)):
+    if nx < ny:
+      tx += sx
+      nx += stepx
+    else:
+      ty += sy
+      ny += stepy
+    tiles.append((tx, ty))
+  return tiles
+
+def split(points, zoom):
+  """Cut a line into the runs of segments crossing each tile: {(x, y): [run, ...]}."""
+  x, y = position(points[:,0], points[:,1], zoom)
+  runs = collections.defaultdict(list)
+  for i in range(len(points) - 1):
+    for k in crossed(x[i], y[i], x[i+1], y[i+1]):
+      r = runs[k]
+      if r and r[-1][1] == i:
+        r[-1][1] = i + 1
+      else:
+        r.append([i, i + 1])
+  return dict((k, [points[a:b+1].tolist() for a, b in v]) for k, v in runs.items())
+
+class Pyramid(object):
+  """Collects route features and writes them as a tile pyramid."""
+  def __init__(self, path, zooms=ZOOMS):
+    self.path = path
+    self.zooms = sorted(zooms)
+    self.routes = []
+    self.tiles = collections.defaultdict(list)
+
+  def add(self, feature):
+    """Add a route group feature; needs a group_id property."""
+    group_id = feature['properties']['group_id']
+    points = numpy.asarray(feature['geometry']['coordinates'], dtype=numpy.float64).reshape(-1, 2)
+    for zoom in self.zooms:
+      simple = quantize(simplify(points, pixel(zoom) / 2), zoom)
+      if zoom == self.zooms[0]:
+        self.routes.append({'type': 'Feature', 'properties': feature['properties'], 'geometry': {'type': 'LineString', 'coordinates': simple.tolist()}})
+        continue
+      for (x, y), lines in split(simple, zoom).items():
+        self.tiles[(zoom, x, y)].append({'type': 'Feature', 'properties': {'group_id': group_id}, 'geometry': {'type': 'MultiLineString', 'coordinates': lines}})
+
+  def write(self):
+    index = {'zooms': self.zooms, 'tiles': collections.defaultdict(list)}
+    dump({'type': 'FeatureCollection', 'features': self.routes}, os.path.join(self.path, 'routes.json'))
+    for (zoom, x, y), features in sorted(self.tiles.items()):
+      dump({'type': 'FeatureCollection', 'features': features}, os.path.join(self.path, str(zoom), str(x), '%s.json'%y))
+      index['tiles'][zoom].append('%s/%s'%(x, y))
+    dump(index, os.path.join(self.path, 'index.json'))
+
+def dump(data, filename):
+  if not os.path.exists(os.path.dirname(filename)):
+    os.makedirs(os.path.dirname(filename))
+  with open(filename, 'wb') as f:
+    json.dump(data, f, separators=(',', ':'))